@@ -105,6 +105,13 @@ def make_subprocess_call(command, shell=False):
     return result.returncode, stdout, stderr
 
 
+def get_ffmpeg_path():
+    if is_grading():
+        return "/home/ubuntu/miniconda3/envs/aicrowd_job_factory/bin/ffmpeg"
+    else:
+        return "ffmpeg"
+
+
 def generate_movie_from_frames(frames_folder):
     """
         Expects the frames in the  frames_folder folder
@@ -116,10 +123,7 @@ def generate_movie_from_frames(frames_folder):
     frames_path = os.path.join(frames_folder, "%04d.jpg")
     thumb_output_path = os.path.join(frames_folder, "out_thumb.mp4")
 
-    if is_grading():
-        ffmpeg_path = "/home/ubuntu/miniconda3/envs/aicrowd_job_factory/bin/ffmpeg"
-    else:
-        ffmpeg_path = "ffmpeg"
+    ffmpeg_path = get_ffmpeg_path()
     return_code, output, output_err = make_subprocess_call(
         ffmpeg_path +
         " -r 7 -start_number 0 -i " +
@@ -0,0 +1,73 @@
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+
+def t_cdf(x: float, df: int) -> float:
+    """CDF of Student's t distribution with an integer number of degrees of freedom (A&S 26.7.3-4)"""
+    theta = math.atan(abs(x) / math.sqrt(df))
+    cos2 = math.cos(theta) ** 2
+    if df % 2 == 1:
+        term, series = 1.0, 1.0 if df > 1 else 0.0
+        for k in range(3, df - 1, 2):
+            term *= cos2 * (k - 1) / k
+            series += term
+        a = 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * series)
+    else:
+        term = series = 1.0
+        for k in range(2, df, 2):
+            term *= cos2 * (k - 1) / k
+            series += term
+        a = math.sin(theta) * series
+    return 0.5 + math.copysign(a / 2, x)  # a is P(|T| < |x|)
+
+
+def t_quantile(p: float, df: int) -> float:
+    """Inverse of t_cdf by bisection"""
+    if not 0 < p < 1:
+        raise ValueError(f"Quantiles are defined for probabilities in (0, 1), not {p}")
+    if df < 1:
+        raise ValueError(f"Student's t distribution needs at least 1 degree of freedom, not {df}")
+    if p < 0.5:
+        return -t_quantile(1 - p, df)
+    low, high = 0.0, max(1.0, NormalDist().inv_cdf(p))  # t quantiles are above the normal ones
+    while t_cdf(high, df) < p:
+        low, high = high, 2 * high
+    for _ in range(100):
+        middle = (low + high) / 2
+        if t_cdf(middle, df) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class RunningStats:
+    """
+    Running mean and sample variance of a stream of scalars or arrays, with Welford's algorithm
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+
+    def add(self, value) -> None:
+        value = np.asarray(value, dtype=np.float64)
+        self.count += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.full(np.shape(self.mean), np.inf)
+        return self.m2 / (self.count - 1)
+
+    def half_width(self, confidence: float):
+        """Half-width of the t-based confidence interval of the mean"""
+        if self.count < 2:
+            return np.full(np.shape(self.mean), np.inf)
+        return t_quantile((1 + confidence) / 2, self.count - 1) * np.sqrt(self.variance / self.count)
@@ -0,0 +1,106 @@
+import queue
+import subprocess
+import tempfile
+import threading
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+
+class VideoEncoder:
+    """
+    Streams RGB frames into a single ffmpeg process encoding them to one or more mp4 files,
+    e.g. a full size video and its thumbnail, without intermediate image files.
+    Frames are piped to ffmpeg by a background thread so that rendering is not blocked.
+
+    Usage:
+        with VideoEncoder([('out.mp4', (600, 600)), ('out_thumb.mp4', (320, 320))], fps=7) as video:
+            for frame in frames:
+                video.write(frame)
+    """
+
+    def __init__(
+            self,
+            outputs: Sequence[Tuple[str, Optional[Tuple[int, int]]]],
+            fps: float = 4,
+            ffmpeg_exec: str = 'ffmpeg',
+            max_queued_frames: int = 64):
+        """`outputs` are (path, resolution) pairs, a None resolution keeps the size of the frames"""
+        if len(outputs) == 0:
+            raise ValueError("VideoEncoder needs at least one output")
+        self.outputs = list(outputs)
+        self.fps = fps
+        self.ffmpeg_exec = ffmpeg_exec
+        self.frame_size = None
+        self.process = None
+        self.stderr = tempfile.TemporaryFile()
+        self.queue = queue.Queue(maxsize=max_queued_frames)
+        self.thread = None
+        self.error = None
+
+    def _start(self, frame_size: Tuple[int, int]) -> None:
+        self.frame_size = frame_size
+        command = [
+            self.ffmpeg_exec, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{frame_size[0]}x{frame_size[1]}', '-r', str(self.fps),
+            '-i', '-'
+        ]
+        for path, resolution in self.outputs:
+            command += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+            if resolution is not None:
+                command += ['-s', f'{resolution[0]}x{resolution[1]}']
+            command.append(path)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr)
+        self.thread = threading.Thread(target=self._pipe, daemon=True)
+        self.thread.start()
+
+    def _pipe(self) -> None:
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.process.stdin.write(frame)
+                except (BrokenPipeError, OSError) as error:
+                    self.error = error  # ffmpeg exited, reported by close()
+
+    def write(self, frame: Union[Image.Image, np.ndarray]) -> None:
+        """Queues a frame given as a PIL image or a (height, width, 3) uint8 array"""
+        if isinstance(frame, Image.Image):
+            frame = np.asarray(frame.convert('RGB'))
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        size = (frame.shape[1], frame.shape[0])
+        if self.process is None:
+            self._start(size)
+        elif size != self.frame_size:
+            raise ValueError(f"Frame size {size} differs from the first frame size {self.frame_size}")
+        self.queue.put(frame.tobytes())
+
+    def close(self) -> Tuple[str, ...]:
+        """Waits for the encoding to finish and returns the output paths"""
+        if self.process is None:
+            raise ValueError("No frame was written")
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.process.stdin.close()
+            self.process.wait()
+        self.stderr.seek(0)
+        output_err = self.stderr.read().decode('utf-8', errors='replace')
+        self.stderr.close()
+        if self.process.returncode != 0:
+            raise Exception(output_err or self.error)
+        return tuple(path for path, _ in self.outputs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.process is not None:
+            self.process.kill()
+            self.queue.put(None)
+            self.thread.join()
@@ -8,7 +8,7 @@ from torch_impl.env.env import DeliveryDrones
 from torch_impl.env.wrappers import WindowedGridView
 from torch_impl.agents.dqn import DQNAgent, DenseQNetworkFactory, ConvQNetworkFactory
 from torch_impl.agents.random import RandomAgent
-from torch_impl.helpers.rl_helpers import set_seed
+from torch_impl.helpers.rl_helpers import act_all, set_seed
 
 
 def create_baseline_models(num_models=5, num_steps=1000):
@@ -76,12 +76,13 @@ def create_baseline_models(num_models=5, num_steps=1000):
         total_reward = 0
         recent_rewards = []
 
-        agents = {drone.index: RandomAgent(env) for drone in env.drones_list}
+        random_agent = RandomAgent(env)
+        agents = {drone.index: random_agent for drone in env.drones_list}
         agents[0] = agent
 
         pbar = tqdm.tqdm(range(num_steps))
         for step in pbar:
-            actions = {key: agent.act(state[key]) for key, agent in agents.items()}
+            actions = act_all(agents, state)
             next_state, rewards, dones, _, _ = env.step(actions)
             step_reward = rewards[0]
 
@@ -1,32 +1,89 @@
+import multiprocessing
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import torch
 import tqdm
 from PIL import Image
 import tempfile
 import aicrowd_helpers
-from torch_impl.agents.dqn import BaseDQNFactory
+from common.stats import RunningStats
+from common.video import VideoEncoder
+from torch_impl.agents.dqn import CachedQNetwork, GroupedQNetworks, load_qnetwork
+from torch_impl.agents.quantization import argmax_agreement, quantize_qnetwork
 from torch_impl.env.env import DeliveryDrones
 from torch_impl.env.wrappers import WindowedGridView
 from torch_impl.helpers.rl_helpers import set_seed
 from common.render import Renderer
 from torch_impl.render_util import convert_for_rendering
 
+_worker_evaluator = None
+
+
+def _init_worker(evaluator_kwargs, submission_file_path):
+    """Loads the baseline and submission models once per worker process"""
+    global _worker_evaluator
+    _worker_evaluator = DroneRacerEvaluator(**evaluator_kwargs)
+    _worker_evaluator.load_submission(submission_file_path)
+
+
+def _run_episode(episode_idx, episode_seed, video_directory_path):
+    return _worker_evaluator.run_episode(episode_idx, episode_seed, video_directory_path)
+
 
 class DroneRacerEvaluator:
-    def __init__(self, answer_folder_path=".", round=1):
+    def __init__(self, answer_folder_path=".", round=1, compile_models=None, quantize_models=False,
+                 quantize_min_agreement=0.99, cache_size=0, num_workers=1, batched_inference=False,
+                 early_stopping_confidence=None, early_stopping_half_width=0.0, early_stopping_min_episodes=3):
         """
         `round` : Holds the round for which the evaluation is being done.
         can be 1, 2...upto the number of rounds the challenge has.
         Different rounds will mostly have different ground truth files.
+        `compile_models` : None to run models eagerly, 'script' or 'compile'
+        to run them compiled (TorchScript submissions are always compiled)
+        `quantize_models` : Run models with int8 weights, each quantized model is
+        only used if its greedy actions agree with the fp32 model on at least
+        `quantize_min_agreement` of a reference set of observations
+        `cache_size` : Memoize the Q-values of up to `cache_size` observations per model
+        `num_workers` : Processes running the episodes, each one loads all the models
+        `batched_inference` : Act with all models at once, models of the same
+        architecture in a single vmapped forward, see GroupedQNetworks
+        `early_stopping_confidence` : Stop playing episodes once, at this confidence,
+        the submission's score is known to within `early_stopping_half_width`
+        or ranks above or below every baseline, after at least `early_stopping_min_episodes`
         """
+        if early_stopping_confidence is not None and not 0 < early_stopping_confidence < 1:
+            raise ValueError(f"early_stopping_confidence should be in (0, 1), not {early_stopping_confidence}")
+        if early_stopping_min_episodes < 2:
+            raise ValueError(f"Confidence intervals need at least 2 episodes, not {early_stopping_min_episodes}")
         self.answer_folder_path = answer_folder_path
         self.round = round
+        self.compile_models = compile_models
+        self.quantize_models = quantize_models
+        self.quantize_min_agreement = quantize_min_agreement
+        self.cache_size = cache_size
+        self.num_workers = num_workers
+        self.batched_inference = batched_inference
+        self.early_stopping_confidence = early_stopping_confidence
+        self.early_stopping_half_width = early_stopping_half_width
+        self.early_stopping_min_episodes = early_stopping_min_episodes
+        self.evaluator_kwargs = {  # Recreates this evaluator in worker processes
+            'answer_folder_path': answer_folder_path,
+            'round': round,
+            'compile_models': compile_models,
+            'quantize_models': quantize_models,
+            'quantize_min_agreement': quantize_min_agreement,
+            'cache_size': cache_size,
+            'batched_inference': batched_inference,
+        }
 
         ################################################
         # Evaluation State Variables
         ################################################
         self.EPISODE_SEEDS = [845, 99, 65, 96, 85, 39, 51, 17, 52, 35]
         self.TOTAL_EPISODE_STEPS = 1000
+        self.REFERENCE_SEEDS = [0, 1]  # Episodes collecting the reference observations of quantized models
+        self.REFERENCE_EPISODE_STEPS = 100
         self.participating_agents = {
             "baseline-1": "sample_models/dqn-agent-1.safetensors",
             "baseline-2": "sample_models/dqn-agent-2.safetensors",
@@ -38,16 +95,77 @@ class DroneRacerEvaluator:
         ################################################
         # Load Baseline models
         ################################################
+        self.reference_states = None
         self.loaded_agent_models = {}
         for _item in self.participating_agents.keys():
             agent_path = os.path.join(answer_folder_path, self.participating_agents[_item])
-            self.loaded_agent_models[_item] = BaseDQNFactory.from_checkpoint(agent_path).create_qnetwork()[0]
+            self.loaded_agent_models[_item] = self.load_model(agent_path)
         # Baseline Models loaded !! Yayy !!
 
     ################################################
     # Helper Functions
     ################################################
 
+    def env_params(self, n_drones):
+        return {  # Updates to the default params have to be added after this instantiation
+            'charge_reward': -0.1,
+            'crash_reward': -1,
+            'delivery_reward': 1,
+            'charge': 20,
+            'discharge': 10,
+            'drone_density': 0.05,
+            'dropzones_factor': 2,
+            'n_drones': n_drones,
+            'packets_factor': 3,
+            'pickup_reward': 0,
+            'rgb_render_rescale': 1.0,
+            'skyscrapers_factor': 3,
+            'stations_factor': 2
+        }
+
+    def load_model(self, path):
+        """
+        Loads a model for inference, cached if enabled
+        """
+        model = self.load_uncached_model(path)
+        return CachedQNetwork(model, self.cache_size) if self.cache_size > 0 else model
+
+    def load_uncached_model(self, path):
+        """
+        Loads a model for inference, quantized if enabled and if it passes the agreement check
+        """
+        if not self.quantize_models:
+            return load_qnetwork(path, self.compile_models)
+
+        model = load_qnetwork(path)
+        try:
+            quantized = quantize_qnetwork(model, self.get_reference_states())
+        except ValueError as error:
+            print(f"Not quantizing {path}: {error}")
+            return model
+        agreement = argmax_agreement(quantized, model, self.get_reference_states())
+        if agreement < self.quantize_min_agreement:
+            print(f"Not quantizing {path}: greedy actions agree on {agreement:.1%} of the reference observations")
+            return model
+        return quantized
+
+    def get_reference_states(self):
+        """
+        Observations of random-action episodes in the evaluation environment,
+        with seeds of their own so that the evaluation episodes are unaffected
+        """
+        if self.reference_states is None:
+            env = WindowedGridView(DeliveryDrones(self.env_params(len(self.participating_agents) + 1)), radius=3)
+            reference_states = []
+            for seed in self.REFERENCE_SEEDS:
+                set_seed(env, seed)
+                state = env.reset()
+                for _ in range(self.REFERENCE_EPISODE_STEPS):
+                    reference_states.extend(state.values())
+                    state, _, _, _, _ = env.step({index: env.action_space.sample() for index in state})
+            self.reference_states = np.stack(reference_states)
+        return self.reference_states
+
     def agent_id(self, agent_name):
         """
         Returns a unique numeric id for an agent_name
@@ -70,80 +188,72 @@ class DroneRacerEvaluator:
             _agent_name_mapping[_agent_id] = _agent_name
         return _agent_name_mapping
 
-    def _evaluate(self, client_payload, _context={}):
+    def load_submission(self, submission_file_path):
+        model = self.load_model(submission_file_path)
+        self.participating_agents["YOU"] = model
+        self.loaded_agent_models["YOU"] = model
+
+    def video_paths(self, video_directory_path):
+        return os.path.join(video_directory_path, "out.mp4"), os.path.join(video_directory_path, "out_thumb.mp4")
+
+    def run_episode(self, episode_idx, episode_seed, video_directory_path):
         """
-        `client_payload` will be a dict with (atleast) the following keys :
-          - submission_file_path : local file path of the submitted file
-          - aicrowd_submission_id : A unique id representing the submission
-          - aicrowd_participant_id : A unique id for participant/team submitting (if enabled)
+        Runs one evaluation episode and returns the score of each agent,
+        the first episode encodes its first frames into the videos of video_directory_path
         """
-        submission_file_path = client_payload["submission_file_path"]
-        aicrowd_submission_id = client_payload["aicrowd_submission_id"]
-        aicrowd_participant_uid = client_payload["aicrowd_participant_id"]
-
-        self.video_directory_path = tempfile.mkdtemp()
-        print("Video Directory Path : ", self.video_directory_path)
+        ################################################
+        # Run Episode
+        ################################################
+        episode_scores = np.zeros(len(self.participating_agents.keys()))
 
         ################################################
-        # Load submission model
+        # Env Instantiation
         ################################################
+        env_params = self.env_params(len(self.participating_agents.keys()))
 
-        model = BaseDQNFactory.from_checkpoint(submission_file_path).create_qnetwork()[0]
-        self.participating_agents["YOU"] = model
-        self.loaded_agent_models["YOU"] = model
+        env = WindowedGridView(DeliveryDrones(env_params), radius=3)
+        set_seed(env, episode_seed)  # Seed
 
-        self.overall_scores = []
+        agent_name_mappings = self.get_agent_name_mapping()
+        env.env_params["player_name_mappings"] = agent_name_mappings
 
-        for _episode_idx, episode_seed in enumerate(self.EPISODE_SEEDS):
-            ################################################
-            # Run Episode
-            ################################################
-            episode_scores = np.zeros(len(self.participating_agents.keys()))
+        renderer = Renderer(
+            env.n_drones,
+            env.side_size,
+            resolution_scale_factor=2.0
+        )
+        renderer.init()
+
+        agent_names = sorted(self.participating_agents.keys())
+        if self.batched_inference:
+            grouped_models = GroupedQNetworks([self.loaded_agent_models[_agent_name] for _agent_name in agent_names])
+
+        if episode_idx == 0:
+            video_output_path, video_thumb_output_path = self.video_paths(video_directory_path)
+            video = VideoEncoder(
+                [(video_output_path, (600, 600)), (video_thumb_output_path, (320, 320))],
+                fps=7,
+                ffmpeg_exec=aicrowd_helpers.get_ffmpeg_path())
+
+        # Gather First Obeservation (state)
+        state = env.reset()
+
+        # Episode step loop
+        for _step in tqdm.tqdm(range(self.TOTAL_EPISODE_STEPS)):
+            _action_dictionary = {}
 
             ################################################
-            # Env Instantiation
+            # Act on the Env (all agents at once)
             ################################################
-            env_params = {  # Updates to the default params have to be added after this instantiation
-                'charge_reward': -0.1,
-                'crash_reward': -1,
-                'delivery_reward': 1,
-                'charge': 20,
-                'discharge': 10,
-                'drone_density': 0.05,
-                'dropzones_factor': 2,
-                'n_drones': 3,
-                'packets_factor': 3,
-                'pickup_reward': 0,
-                'rgb_render_rescale': 1.0,
-                'skyscrapers_factor': 3,
-                'stations_factor': 2
-            }
-            env_params["n_drones"] = len(self.participating_agents.keys())
-
-            env = WindowedGridView(DeliveryDrones(env_params), radius=3)
-            set_seed(env, episode_seed)  # Seed
-
-            agent_name_mappings = self.get_agent_name_mapping()
-            env.env_params["player_name_mappings"] = agent_name_mappings
-
-            renderer = Renderer(
-                env.n_drones,
-                env.side_size,
-                resolution_scale_factor=2.0
-            )
-            renderer.init()
-
-            # Gather First Obeservation (state)
-            state = env.reset()
-
-            # Episode step loop
-            for _step in tqdm.tqdm(range(self.TOTAL_EPISODE_STEPS)):
-                _action_dictionary = {}
-
+            if self.batched_inference:
+                with torch.no_grad():
+                    q_values = grouped_models(np.stack([state[_idx] for _idx in range(len(agent_names))]))
+                _action_dictionary = dict(enumerate(q_values.argmax(dim=1).tolist()))
+            else:
                 ################################################
                 # Act on the Env (all agents, one after the other)
                 ################################################
-                for _idx, _agent_name in enumerate(sorted(self.participating_agents.keys())):
+                for _idx, _agent_name in enumerate(agent_names):
                     agent = self.loaded_agent_models[_agent_name]
 
                     ################################################
@@ -154,43 +264,106 @@ class DroneRacerEvaluator:
                     ################################################
                     # Decide action of the participating agent
                     ################################################
-                    q_values = agent([state_agent])[0]
+                    with torch.no_grad():
+                        q_values = agent([state_agent])[0]
                     action = q_values.argmax().item()
                     _action_dictionary[_idx] = action
 
-                # Perform action (on all agents)
-                state, rewards, _, _, _ = env.step(_action_dictionary)
+            # Perform action (on all agents)
+            state, rewards, _, _, _ = env.step(_action_dictionary)
 
-                # Gather rewards for all agents (inside episode_score)
-                _step_score = np.array(list(rewards.values()))  # Check with florian about ordering
+            # Gather rewards for all agents (inside episode_score)
+            _step_score = np.array(list(rewards.values()))  # Check with florian about ordering
 
-                episode_scores += _step_score
+            episode_scores += _step_score
+
+            ################################################
+            # Collect frames for the first episode to generate video
+            ################################################
+            if episode_idx == 0:
+                if _step < 60:
+                    # Use only the first 60 frames for video generation
+                    # Frames are streamed to ffmpeg, which encodes them in the background
+
+                    ground, air, carrying_package, charge = convert_for_rendering(env)
+                    _step_frame_im = renderer.render_frame(
+                        ground, air, carrying_package, charge, rewards, _action_dictionary)
+                    video.write(_step_frame_im)
+
+        if episode_idx == 0:
+            video.close()
+        return episode_scores
+
+    def collect_scores(self, episode_scores):
+        """
+        Gathers the scores of the episodes in order, stopping early if enabled
+        The confidence intervals are t-based, of the submission's mean score and of its
+        mean score difference to each baseline over the same episodes. They are checked after
+        every episode from `early_stopping_min_episodes` on, so each check uses a Bonferroni
+        corrected confidence for the intervals to hold at `early_stopping_confidence` over all
+        the checks (the baselines' intervals are not corrected for their number)
+        """
+        overall_scores = []
+        _idx_of_submitted_agent = self.agent_id("YOU")
+        stats = RunningStats()
+        if self.early_stopping_confidence is not None:
+            n_checks = max(1, len(self.EPISODE_SEEDS) - self.early_stopping_min_episodes + 1)
+            confidence = 1 - (1 - self.early_stopping_confidence) / n_checks
+        for scores in episode_scores:
+            overall_scores.append(scores)
+            if self.early_stopping_confidence is None:
+                continue
+            differences = np.delete(scores[_idx_of_submitted_agent] - scores, _idx_of_submitted_agent)
+            stats.add(np.concatenate([[scores[_idx_of_submitted_agent]], differences]))
+            half_widths = stats.half_width(confidence)
+            self.score_interval = (stats.mean[0] - half_widths[0], stats.mean[0] + half_widths[0])
+            if stats.count >= self.early_stopping_min_episodes and (
+                    half_widths[0] <= self.early_stopping_half_width
+                    or np.all(np.abs(stats.mean[1:]) > half_widths[1:])):  # Rank decided
+                break
+        return overall_scores
+
+    def _evaluate(self, client_payload, _context={}):
+        """
+        `client_payload` will be a dict with (atleast) the following keys :
+          - submission_file_path : local file path of the submitted file
+          - aicrowd_submission_id : A unique id representing the submission
+          - aicrowd_participant_id : A unique id for participant/team submitting (if enabled)
+        """
+        submission_file_path = client_payload["submission_file_path"]
+        aicrowd_submission_id = client_payload["aicrowd_submission_id"]
+        aicrowd_participant_uid = client_payload["aicrowd_participant_id"]
+
+        self.video_directory_path = tempfile.mkdtemp()
+        print("Video Directory Path : ", self.video_directory_path)
+
+        ################################################
+        # Load submission model
+        ################################################
+
+        self.load_submission(submission_file_path)
+
+        episode_indices = range(len(self.EPISODE_SEEDS))
+        video_directory_paths = [self.video_directory_path] * len(self.EPISODE_SEEDS)
+        if self.num_workers > 1:
+            # Episodes reseed everything, so they score the same in any process
+            executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.evaluator_kwargs, submission_file_path))
+            episode_scores = executor.map(_run_episode, episode_indices, self.EPISODE_SEEDS, video_directory_paths)
+        else:
+            executor = None
+            episode_scores = map(self.run_episode, episode_indices, self.EPISODE_SEEDS, video_directory_paths)
+        try:
+            self.overall_scores = self.collect_scores(episode_scores)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)  # Episodes left after stopping early
 
-                ################################################
-                # Collect frames for the first episode to generate video
-                ################################################
-                if _episode_idx == 0:
-                    if _step < 60:
-                        # Use only the first 60 frames for video generation
-                        # Record videos with env.render
-                        # Do it in a tempfile
-                        # Compile frames into a video (from flatland)
-
-                        ground, air, carrying_package, charge = convert_for_rendering(env)
-                        _step_frame_im = renderer.render_frame(
-                            ground, air, carrying_package, charge, rewards, _action_dictionary)
-                        # _step_frame_im = Image.fromarray(np.random.randint(low=0, high=255, size=(250, 250), dtype=np.uint8))
-                        _step_frame_im.save("{}/{}.jpg".format(self.video_directory_path, str(_step).zfill(4)))
-
-            # Store the current episode scores
-            self.overall_scores.append(episode_scores)
         print("Video directory : ", self.video_directory_path)
-        # Post Process Video
-        print("Generating Video from thumbnails...")
-        video_output_path, video_thumb_output_path = \
-            aicrowd_helpers.generate_movie_from_frames(
-                self.video_directory_path
-            )
+        video_output_path, video_thumb_output_path = self.video_paths(self.video_directory_path)
         print("Videos : ", video_output_path, video_thumb_output_path)
 
         # Aggregate all scores into an overall score
@@ -205,6 +378,10 @@ class DroneRacerEvaluator:
 
         # Post process videos
 
+        if self.cache_size > 0 and self.num_workers == 1:  # Caches of workers are not sent back
+            for _agent_name, _model in self.loaded_agent_models.items():
+                print(f"Q-value cache hit rate of {_agent_name}: {_model.hit_rate:.1%}")
+
         print("Scores : ", score, score_secondary)
         print(self.overall_scores)
 
@@ -214,6 +391,12 @@ class DroneRacerEvaluator:
             "media_video_path": video_output_path,
             "media_video_thumb_path": video_thumb_output_path
         }
+        if self.early_stopping_confidence is not None:
+            episodes = len(self.overall_scores)
+            print(f"Stopped after {episodes} episodes, score interval: {self.score_interval}")
+            _result_object["episodes"] = episodes
+            _result_object["steps_saved"] = (len(self.EPISODE_SEEDS) - episodes) * self.TOTAL_EPISODE_STEPS
+            _result_object["score_interval"] = self.score_interval
 
         return _result_object
 
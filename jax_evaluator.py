@@ -0,0 +1,244 @@
+import math
+import os.path
+import tempfile
+from timeit import default_timer as timer
+import jax
+import jax.numpy as jnp
+import jax.random
+import numpy as np
+import aicrowd_helpers
+from common.render import Renderer
+from common.video import VideoEncoder
+from drone_evaluator import DroneRacerEvaluator
+from jax_impl.agents.dqn import DQNAgent, DQNAgentParams
+from jax_impl.env.env import DroneEnvParams, DeliveryDrones
+from jax_impl.render_util import convert_jax_state
+
+
+class JaxDroneRacerEvaluator:
+    """
+    DroneRacerEvaluator running the scoring episodes on the JAX environment
+
+    All the episodes of a submission are played at once, vmapped over the episode seeds inside a
+    jitted lax.scan over the steps. Several submissions of the same architecture are scored by the
+    same compiled program, vmapped over their stacked parameters.
+    The JAX environment spawns objects with its own random numbers, so scores differ from the ones
+    of DroneRacerEvaluator for the same seeds.
+    """
+
+    def __init__(self, answer_folder_path=".", round=1, measure_speedup=False):
+        """
+        `round` : Holds the round for which the evaluation is being done.
+        `measure_speedup` : Also time DroneRacerEvaluator on the same submissions
+        and report how many times faster this evaluator was
+        """
+        self.answer_folder_path = answer_folder_path
+        self.round = round
+        self.measure_speedup = measure_speedup
+
+        ################################################
+        # Evaluation State Variables
+        ################################################
+        self.EPISODE_SEEDS = [845, 99, 65, 96, 85, 39, 51, 17, 52, 35]
+        self.TOTAL_EPISODE_STEPS = 1000
+        self.VIDEO_EPISODE_STEPS = 60
+        self.participating_agents = {
+            "baseline-1": "sample_models/dqn-agent-1.safetensors",
+            "baseline-2": "sample_models/dqn-agent-2.safetensors",
+            "baseline-3": "sample_models/dqn-agent-3.safetensors",
+            "baseline-4": "sample_models/dqn-agent-4.safetensors",
+            "baseline-5": "sample_models/dqn-agent-5.safetensors",
+        }
+        self.env = DeliveryDrones()
+        self.dqn_agent = DQNAgent()
+        self.programs = {}  # Compiled programs by submission Q-network
+
+        ################################################
+        # Load Baseline models
+        ################################################
+        self.loaded_agent_models = {}
+        for _item in self.participating_agents.keys():
+            agent_path = os.path.join(answer_folder_path, self.participating_agents[_item])
+            self.loaded_agent_models[_item] = self.load_model(agent_path)
+
+    def env_params(self, n_drones):
+        drone_density = 0.05
+        return DroneEnvParams(
+            grid_size=int(math.ceil(math.sqrt(n_drones / drone_density))),  # Same grid as DroneRacerEvaluator
+            n_drones=n_drones,
+            pickup_reward=0.0,
+            delivery_reward=1.0,
+            crash_reward=-1.0,
+            charge_reward=-0.1,
+            discharge=10,
+            charge=20,
+            packets_factor=3,
+            dropzones_factor=2,
+            stations_factor=2,
+            skyscrapers_factor=3,
+            window_radius=3,
+        )
+
+    def load_model(self, path):
+        """
+        Returns the Flax Q-network and parameters of a PyTorch checkpoint
+        """
+        ag_state = self.dqn_agent.reset(
+            jax.random.PRNGKey(0), DQNAgentParams(), self.env_params(len(self.participating_agents) + 1))
+        ag_state = self.dqn_agent.load_from_torch(path, ag_state)
+        return ag_state.qnetwork, ag_state.qnetwork_params
+
+    def agent_names(self):
+        return sorted([*self.participating_agents.keys(), "YOU"])
+
+    def run_episode(self, qnetworks, params, seed, num_steps, record=False):
+        """
+        Plays one episode where agent i acts greedily with qnetworks[i] and params[i],
+        returns the score of each agent and, if record, the states, actions and rewards of each step
+        """
+        env_params = self.env_params(len(qnetworks))
+        key, reset_key = jax.random.split(jax.random.PRNGKey(seed))
+        state = self.env.reset(reset_key, env_params)
+
+        def _step(carry, _):
+            key, state = carry
+            key, step_key = jax.random.split(key)
+            obs = self.env.get_obs(state, env_params).reshape(len(qnetworks), -1)
+            actions = jnp.stack([
+                jnp.argmax(qnetwork.apply(agent_params, agent_obs))
+                for qnetwork, agent_params, agent_obs in zip(qnetworks, params, obs)])
+            state, rewards, _ = self.env.step(step_key, state, actions, env_params)
+            return (key, state), ((state, actions, rewards) if record else rewards)
+
+        _, steps = jax.lax.scan(_step, (key, state), None, length=num_steps)
+        rewards = steps[2] if record else steps
+        return (rewards.sum(axis=0), steps) if record else rewards.sum(axis=0)
+
+    def get_programs(self, qnetwork):
+        """
+        Jitted programs for submissions of this Q-network: scoring stacked submission parameters
+        on all the episodes, and recording the first steps of an episode of a single submission
+        """
+        if qnetwork not in self.programs:
+            agent_names = self.agent_names()
+            qnetworks = [
+                qnetwork if _agent_name == "YOU" else self.loaded_agent_models[_agent_name][0]
+                for _agent_name in agent_names]
+
+            def _params(baseline_params, submission_params):
+                return [
+                    submission_params if _agent_name == "YOU" else baseline_params[_agent_name]
+                    for _agent_name in agent_names]
+
+            def _score(baseline_params, submission_params, seeds):
+                def _episode(submission_params, seed):
+                    return self.run_episode(
+                        qnetworks, _params(baseline_params, submission_params), seed, self.TOTAL_EPISODE_STEPS)
+                episodes = jax.vmap(_episode, in_axes=(None, 0))
+                return jax.vmap(episodes, in_axes=(0, None))(submission_params, seeds)
+
+            def _record(baseline_params, submission_params, seed):
+                return self.run_episode(
+                    qnetworks, _params(baseline_params, submission_params), seed, self.VIDEO_EPISODE_STEPS,
+                    record=True)[1]
+
+            self.programs[qnetwork] = jax.jit(_score), jax.jit(_record)
+        return self.programs[qnetwork]
+
+    def baseline_params(self):
+        return {_agent_name: params for _agent_name, (_, params) in self.loaded_agent_models.items()}
+
+    def video_paths(self, video_directory_path):
+        return os.path.join(video_directory_path, "out.mp4"), os.path.join(video_directory_path, "out_thumb.mp4")
+
+    def record_video(self, qnetwork, params, video_directory_path):
+        """
+        Renders the first steps of the first episode into the videos of video_directory_path
+        """
+        _, record = self.get_programs(qnetwork)
+        states, actions, rewards = jax.device_get(record(self.baseline_params(), params, self.EPISODE_SEEDS[0]))
+        env_params = self.env_params(len(self.agent_names()))
+        renderer = Renderer(env_params.n_drones, env_params.grid_size, resolution_scale_factor=2.0)
+        renderer.init()
+        video_output_path, video_thumb_output_path = self.video_paths(video_directory_path)
+        with VideoEncoder(
+                [(video_output_path, (600, 600)), (video_thumb_output_path, (320, 320))],
+                fps=7,
+                ffmpeg_exec=aicrowd_helpers.get_ffmpeg_path()) as video:
+            for _step in range(self.VIDEO_EPISODE_STEPS):
+                state = jax.tree_util.tree_map(lambda x: x[_step], states)
+                video.write(renderer.render_frame(*convert_jax_state(state, actions[_step], rewards[_step])))
+        return video_output_path, video_thumb_output_path
+
+    def evaluate_submissions(self, submission_file_paths):
+        """
+        Scores several submissions, those of the same architecture in a single compiled program,
+        and returns a result object per submission
+        """
+        models = [self.load_model(path) for path in submission_file_paths]
+        overall_scores = [None] * len(models)
+        start = timer()
+        for qnetwork in dict.fromkeys(qnetwork for qnetwork, _ in models):
+            indices = [_idx for _idx, (_qnetwork, _) in enumerate(models) if _qnetwork == qnetwork]
+            submission_params = jax.tree_util.tree_map(
+                lambda *params: jnp.stack(params), *[models[_idx][1] for _idx in indices])
+            score, _ = self.get_programs(qnetwork)
+            scores = jax.device_get(score(self.baseline_params(), submission_params, jnp.array(self.EPISODE_SEEDS)))
+            for _idx, _scores in zip(indices, scores):
+                overall_scores[_idx] = np.asarray(_scores, dtype=np.float64)
+        elapsed = timer() - start  # Including compilation
+        print(f"Played the episodes of {len(models)} submissions in {elapsed:.2f}s")
+
+        _idx_of_submitted_agent = self.agent_names().index("YOU")
+        results = []
+        for (qnetwork, params), _scores in zip(models, overall_scores):
+            video_directory_path = tempfile.mkdtemp()
+            video_output_path, video_thumb_output_path = self.record_video(qnetwork, params, video_directory_path)
+            results.append({
+                "score": _scores.mean(axis=0)[_idx_of_submitted_agent],
+                "score_secondary": _scores.std(axis=0)[_idx_of_submitted_agent],
+                "media_video_path": video_output_path,
+                "media_video_thumb_path": video_thumb_output_path
+            })
+
+        if self.measure_speedup:
+            speedup = self.torch_episodes_seconds(submission_file_paths) / elapsed
+            print(f"Speedup over DroneRacerEvaluator: {speedup:.1f}x")
+            for result in results:
+                result["speedup"] = speedup
+        return results
+
+    def torch_episodes_seconds(self, submission_file_paths):
+        """
+        Time DroneRacerEvaluator takes to play the episodes of the submissions, without rendering
+        """
+        torch_evaluator = DroneRacerEvaluator(self.answer_folder_path, self.round)
+        start = timer()
+        for path in submission_file_paths:
+            torch_evaluator.load_submission(path)
+            for _episode_idx, _episode_seed in enumerate(self.EPISODE_SEEDS, start=1):  # Only episode 0 records
+                torch_evaluator.run_episode(_episode_idx, _episode_seed, None)
+        return timer() - start
+
+    def _evaluate(self, client_payload, _context={}):
+        """
+        `client_payload` will be a dict with (atleast) the following keys :
+          - submission_file_path : local file path of the submitted file
+          - aicrowd_submission_id : A unique id representing the submission
+          - aicrowd_participant_id : A unique id for participant/team submitting (if enabled)
+        """
+        return self.evaluate_submissions([client_payload["submission_file_path"]])[0]
+
+
+if __name__ == "__main__":
+    answer_file_path = "."
+    _client_payload = {}
+    _client_payload["submission_file_path"] = "sample_models/dqn-agent-1.safetensors"
+    _client_payload["aicrowd_submission_id"] = 1123
+    _client_payload["aicrowd_participant_id"] = 1234
+
+    # Instantiate an evaluator
+    aicrowd_evaluator = JaxDroneRacerEvaluator(answer_file_path, measure_speedup=True)
+    # Evaluate
+    result = aicrowd_evaluator._evaluate(_client_payload)
+    print(result)
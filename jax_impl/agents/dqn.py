@@ -51,6 +51,30 @@ class DenseQNetwork(nn.Module):
         return x
 
 
+class ConvQNetwork(nn.Module):
+    """
+    Conv + dense Q-network of flattened observations, laid out like the PyTorch ConvQNetwork
+    conv_layers are (out_channels, kernel_size, stride, padding) tuples
+    """
+    obs_shape: Tuple[int, ...] = (7, 7, 6)
+    conv_layers: Tuple[Tuple[int, int, int, int], ...] = ((8, 3, 1, 1),)
+    hidden_layers: Tuple[int, ...] = ()
+
+    @nn.compact
+    def __call__(self, x):
+        x = x.reshape(*x.shape[:-1], *self.obs_shape)
+        for out_channels, kernel_size, stride, padding in self.conv_layers:
+            x = nn.Conv(out_channels, (kernel_size, kernel_size), strides=stride, padding=padding)(x)
+            x = nn.relu(x)
+        x = jnp.moveaxis(x, -1, -3)  # PyTorch flattens channels first
+        x = x.reshape(*x.shape[:-3], -1)
+        for n_features in self.hidden_layers:
+            x = nn.Dense(n_features)(x)
+            x = nn.relu(x)
+        x = nn.Dense(Action.num_actions())(x)
+        return x
+
+
 class DQNAgent():
     def reset(self, rng: jnp.ndarray, ag_params: DQNAgentParams, env_params: DroneEnvParams) -> DQNAgentState:
         if env_params.wrapper != 'window':
@@ -157,28 +181,37 @@ class DQNAgent():
         metadata = safe_open(path, 'np').metadata()
         if metadata.get('checkpoint_format', 'torch') != 'torch':
             raise Exception(f'The checkpoint under {path} is not a PyTorch checkpoint')
-        if metadata.get('network_type', 'dense') not in ['dense']:
-            raise Exception(f'The checkpoint under {path} is of network type {metadata.get("network_type")} which is currently not supported.')
+        network_type = metadata.get('network_type', 'dense')
+        if network_type not in ['dense', 'conv']:
+            raise Exception(
+                    f'The checkpoint under {path} is of network type {network_type} which is currently not supported.')
         params = load_file(path)
         new_params = {}
         for original_key, v in params.items():
             key = original_key.split('.')
             if key[0] == 'network':
                 key[0] = 'params'
-            if key[1].startswith('dense'):
-                new_key_name = key[1].capitalize()  # dense => Dense
+            if key[1].startswith('dense') or key[1].startswith('conv2d'):
+                new_key_name = key[1].replace('conv2d', 'conv').capitalize()  # dense => Dense, conv2d => Conv
                 new_key_name, layer_idx = new_key_name.split('_')
                 new_key_name = new_key_name + '_' + str(int(layer_idx) - 1)
                 key[1] = new_key_name
             if key[-1] == 'weight':
-                v = v.T
+                v = v.T if v.ndim == 2 else v.transpose(2, 3, 1, 0)  # (out, in, h, w) => (h, w, in, out)
                 key[-1] = 'kernel'
             new_key = '.'.join(key)
             new_params[new_key] = v
         params = new_params
         params = unflatten_dict(params, sep='.')
         hidden_layers = ast.literal_eval(metadata.get('dense_layers'))
-        qnetwork = DenseQNetwork(hidden_layers)
+        if network_type == 'conv':
+            conv_layers = tuple(
+                    (layer['out_channels'], layer['kernel_size'], layer.get('stride', 1), layer.get('padding', 0))
+                    for layer in ast.literal_eval(metadata['conv_layers']))
+            obs_shape = ast.literal_eval(metadata['obs_shape'])
+            qnetwork = ConvQNetwork(obs_shape, conv_layers, hidden_layers)
+        else:
+            qnetwork = DenseQNetwork(hidden_layers)
         ag_state = ag_state.replace(
                 qnetwork=qnetwork,
                 qnetwork_params=params,
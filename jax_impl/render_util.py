@@ -1,7 +1,5 @@
-from typing import Tuple, Optional
-import shutil
+from typing import Tuple
 import os
-import tempfile
 import jax
 import jax.numpy as jnp
 import numpy as np
@@ -9,6 +7,7 @@ from tqdm import trange
 import logging
 
 from common.render import Renderer
+from common.video import VideoEncoder
 from jax_impl.env.env import DroneEnvParams, DeliveryDrones
 from jax_impl.agents.dqn import DQNAgent, DQNAgentState
 
@@ -35,7 +34,6 @@ def render_video(
         ag_state: DQNAgentState,
         num_steps: int = 200,
         output_path: str = './out.mp4',
-        temp_dir: Optional[str] = None,
         fps: int = 3,
         resolution_scale_factor: float = 3,
         seed: int = 0):
@@ -52,10 +50,8 @@ def render_video(
     # starting frame
     img = renderer.render_frame(*convert_jax_state(env_state, jnp.array(env_params.n_drones * [4]), jnp.array(env_params.n_drones * [0.0])))
 
-    if temp_dir is None:
-        temp_dir = tempfile.mkdtemp()
-    os.makedirs(temp_dir, exist_ok=True)
-    renderer.save_frame(img, temp_dir)
+    video = VideoEncoder([(output_path, None)], fps=fps)
+    video.write(img)
 
     logger.info('Generating video...')
     for step in trange(1, num_steps):
@@ -67,7 +63,6 @@ def render_video(
         actions = actions.at[0].set(dqn_action)
         env_state, rewards, dones = step_jit(rng, env_state, actions, env_params)
         img = renderer.render_frame(*convert_jax_state(env_state, actions, rewards))
-        renderer.save_frame(img, temp_dir)
-    renderer.generate_video(temp_dir, output_path, output_resolution=img.size, fps=fps)
-    shutil.rmtree(temp_dir)
+        video.write(img)
+    video.close()
     logger.info(f'Generated video {os.path.abspath(output_path)}')
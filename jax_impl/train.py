@@ -176,7 +176,7 @@ def train():
     logger.info(f'... eval of {num_test_steps:,} steps took {timer()-ts:.3f}s. Mean reward: {mean_reward}')
 
     # render_video(test_env_params, ag_state)
-    render_video(test_env_params, ag_state, temp_dir='output', num_steps=200)
+    render_video(test_env_params, ag_state, num_steps=200)
 
 
 if __name__ == "__main__":
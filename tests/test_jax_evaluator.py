@@ -0,0 +1,23 @@
+import numpy as np
+from jax_evaluator import JaxDroneRacerEvaluator
+
+
+def test_stacked_submissions_score_like_single_ones():
+    evaluator = JaxDroneRacerEvaluator()
+    evaluator.TOTAL_EPISODE_STEPS = 100
+    paths = ["sample_models/dqn-agent-1.safetensors", "sample_models/dqn-agent-5.safetensors",
+             "sample_models/dqn-agent-1.safetensors"]
+    results = evaluator.evaluate_submissions(paths)
+    assert len(results) == 3
+    # One program per architecture
+    assert len(evaluator.programs) == 2
+    result = evaluator._evaluate({
+        "submission_file_path": paths[0],
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert set(result) == {"score", "score_secondary", "media_video_path", "media_video_thumb_path"}
+    for other in [results[0], results[2]]:
+        assert np.isclose(other["score"], result["score"])
+        assert np.isclose(other["score_secondary"], result["score_secondary"])
+    assert not np.isclose(results[1]["score"], result["score"])
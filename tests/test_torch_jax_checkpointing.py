@@ -59,3 +59,16 @@ def test_dqn_agent_save(jax_dqn_agent, jax_obs):
             py_out = py_agent.qnetwork([torch.from_numpy(np.asarray(jax_obs).copy())])[0]
         jax_out = ag_state.qnetwork.apply(ag_state.qnetwork_params, jax_obs)
         assert torch.allclose(py_out, torch.from_numpy(np.asarray(jax_out).copy()))
+
+
+def test_load_conv_torch_checkpoint(jax_dqn_agent):
+    env_params = DroneEnvParams()
+    ag_state = jax_dqn_agent.reset(jax.random.PRNGKey(0), DQNAgentParams(), env_params)
+    path = 'sample_models/dqn-agent-5.safetensors'
+    ag_state = jax_dqn_agent.load_from_torch(path, ag_state)
+    obs = np.random.rand(4, 7, 7, 6).astype(np.float32)
+    jax_out = ag_state.qnetwork.apply(ag_state.qnetwork_params, obs.reshape(4, -1))
+    py_qnetwork, _ = BaseDQNFactory.from_checkpoint(path).create_qnetwork()
+    with torch.no_grad():
+        py_out = py_qnetwork(obs).cpu()
+    assert torch.allclose(py_out, torch.from_numpy(np.asarray(jax_out).copy()), atol=1e-5)
@@ -0,0 +1,103 @@
+import random
+
+import numpy as np
+import pytest
+
+from common.constants import Object
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.array_env import EMPTY, ArrayDeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView
+
+
+def run_episode(engine, env_params, seed, n_steps):
+    env = WindowedGridView(DeliveryDrones(env_params, engine=engine), radius=3)
+    random.seed(seed)
+    env.reset()
+    actions_rng = np.random.RandomState(seed)
+
+    trace = []
+    for _ in range(n_steps):
+        actions = dict(enumerate(actions_rng.randint(0, env.action_space.n, size=env.n_drones).tolist()))
+        states, rewards, dones, _, _ = env.step(actions)
+        trace.append({
+            'rewards': rewards,
+            'dones': dones,
+            'drones': [(position, drone.index, drone.charge, drone.packet) for position, drone in env.drones.items()],
+            'packets': sorted(env.packets),
+            'dropzones': sorted(env.dropzones),
+            'stations': sorted(env.stations),
+            'skyscrapers': sorted(env.skyscrapers),
+            'states': {index: state.tobytes() for index, state in states.items()},
+        })
+    return trace
+
+
+def test_engine_flag():
+    assert isinstance(DeliveryDrones({'n_drones': 3}, engine='array'), ArrayDeliveryDrones)
+    assert type(DeliveryDrones({'n_drones': 3})) is DeliveryDrones
+    with pytest.raises(ValueError):
+        DeliveryDrones({'n_drones': 3}, engine='unknown')
+
+
+@pytest.mark.parametrize("env_params", [
+    {'n_drones': 3},
+    {'n_drones': 40, 'drone_density': 0.08},
+    {'n_drones': 100, 'drone_density': 0.2,
+     'packets_factor': 1, 'dropzones_factor': 1, 'stations_factor': 1, 'skyscrapers_factor': 1},
+])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("respawn_sampler", ['rejection', 'index'])
+def test_parity_with_dict_engine(env_params, seed, respawn_sampler):
+    env_params = {**env_params, 'respawn_sampler': respawn_sampler}
+    dict_trace = run_episode('dict', env_params, seed, n_steps=200)
+    array_trace = run_episode('array', env_params, seed, n_steps=200)
+    for step, (expected, actual) in enumerate(zip(dict_trace, array_trace)):
+        for key in expected.keys():
+            assert expected[key] == actual[key], f"{key} differs at step {step}"
+
+
+def test_blocked_cell_counts():
+    env = DeliveryDrones({'n_drones': 40, 'drone_density': 0.08}, engine='array')
+    random.seed(0)
+    env.reset()
+    actions_rng = np.random.RandomState(0)
+    for _ in range(100):
+        env.step(actions_rng.randint(0, 5, size=env.n_drones))
+        assert env.n_flying == np.count_nonzero(env.air != EMPTY) == env.n_drones
+        assert env.n_ground_objects == np.count_nonzero(env.ground)
+        assert env.n_skyscrapers == np.count_nonzero(env.ground == Object.SKYSCRAPER)
+
+
+def layout_of(env):
+    return [
+        [(position, drone.index) for position, drone in env.drones.items()],
+        sorted(env.packets), sorted(env.dropzones), sorted(env.stations), sorted(env.skyscrapers),
+    ]
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+def test_vectorized_reset(engine):
+    env_params = {'n_drones': 40, 'drone_density': 0.08, 'reset_sampler': 'vectorized'}
+    env = DeliveryDrones(env_params, engine=engine)
+    env.reset(seed=3)
+    layout = layout_of(env)
+
+    ground = [*layout[1], *layout[2], *layout[3], *layout[4]]
+    assert len(set(ground)) == len(ground)
+    assert len(layout[0]) == env.n_drones
+    assert sorted(index for _, index in layout[0]) == list(range(env.n_drones))
+    assert not {position for position, _ in layout[0]} & set(layout[4])
+
+    env.reset(seed=3)
+    assert layout_of(env) == layout
+    env.reset()
+    assert sorted(env.skyscrapers) != layout[4]
+
+
+def test_vectorized_reset_engines_agree():
+    env_params = {'n_drones': 40, 'reset_sampler': 'vectorized'}
+    dict_env = DeliveryDrones(env_params)
+    array_env = DeliveryDrones(env_params, engine='array')
+    dict_env.reset(seed=5)
+    array_env.reset(seed=5)
+    assert layout_of(dict_env) == layout_of(array_env)
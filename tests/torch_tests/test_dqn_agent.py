@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+import torch
+
+from torch_impl.agents.dqn import DQNAgent, DenseQNetworkFactory
+from torch_impl.agents.random import RandomAgent
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView
+from torch_impl.helpers.rl_helpers import act_all, learn_all
+
+
+def make_agent(env, **kwargs):
+    params = dict(gamma=0.95, epsilon_start=1.0, epsilon_decay=0.99, epsilon_end=0.01,
+                  memory_size=1000, batch_size=8, target_update_interval=4)
+    params.update(kwargs)
+    factory = DenseQNetworkFactory(env.observation_space.shape, (env.action_space.n,), hidden_layers=(16,))
+    return DQNAgent(env=env, dqn_factory=factory, **params)
+
+
+def test_act_batch_greedy_matches_act():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 20}), radius=2)
+    states = env.reset()
+    agent = make_agent(env)
+    agent.is_greedy = True
+    keys = list(states.keys())
+    actions = agent.act_batch([states[key] for key in keys], keys)
+    assert actions == {key: agent.act(states[key]) for key in keys}
+
+
+def test_act_batch_explores():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 20}), radius=2)
+    states = env.reset()
+    agent = make_agent(env)
+    agent.epsilon = 0.5
+    np.random.seed(0)
+    keys = list(states.keys()) * 50
+    actions = agent.act_batch([states[key % 20] for key in keys], list(range(len(keys))))
+    counts = np.bincount(list(actions.values()), minlength=env.action_space.n)
+    # Greedy actions go to few actions, exploration covers them all
+    assert (counts > 0).all()
+
+
+def test_act_all_groups_shared_agents():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 6}), radius=2)
+    states = env.reset()
+    shared = make_agent(env)
+    shared.is_greedy = True
+    calls = []
+    shared_act_batch = shared.act_batch
+
+    def act_batch(states, agent_ids):
+        calls.append(list(agent_ids))
+        return shared_act_batch(states, agent_ids)
+    shared.act_batch = act_batch
+
+    random_agent = RandomAgent(env)
+    agents = {0: shared, 1: random_agent, 2: shared, 3: random_agent, 4: shared, 5: make_agent(env)}
+    with torch.no_grad():
+        actions = act_all(agents, states)
+    assert list(actions.keys()) == list(agents.keys())
+    assert calls == [[0, 2, 4]]
+    assert all(0 <= action < env.action_space.n for action in actions.values())
+
+
+def test_learn_all_pools_shared_agent():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 4}), radius=2)
+    states = env.reset()
+    shared = make_agent(env, n_drones=3)
+    single = make_agent(env)
+    agents = {0: shared, 1: shared, 2: single, 3: shared}
+    weights = [param.clone() for param in shared.qnetwork.parameters()]
+    for step in range(10):
+        actions = act_all(agents, states)
+        next_states, rewards, dones, _, _ = env.step(actions)
+        dones = {key: step == 9 for key in dones}
+        learn_all(agents, states, actions, rewards, next_states, dones)
+        states = next_states
+    assert len(shared.memory) == 30 and shared.total_steps == 10
+    assert len(single.memory) == 10 and single.total_steps == 10
+    assert shared.num_episode == 3 and shared.epsilon == 0.99 ** 3
+    assert any(not torch.equal(weight, param) for weight, param in zip(weights, shared.qnetwork.parameters()))
+
+    with pytest.raises(ValueError):
+        shared.learn_batch([states[0]], [0], [0.0], [states[0]], [False], ['extra drone'])
+
+
+@pytest.mark.parametrize("fuse", [False, True])
+def test_train_every_and_gradient_steps(fuse):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 2}), radius=2)
+    agent = make_agent(env, train_every=4, gradient_steps=3, fuse_gradient_steps=fuse)
+    batch_sizes = []
+    sample_batch = agent.sample_batch
+
+    def recording_sample_batch():
+        batch = sample_batch()
+        batch_sizes.append(len(batch[1]))
+        return batch
+    agent.sample_batch = recording_sample_batch
+
+    states = env.reset()
+    for step in range(40):
+        next_states, rewards, dones, _, _ = env.step({0: 0, 1: 0})
+        agent.learn(states[0], 0, rewards[0], next_states[0], False)
+        states = next_states
+    # Training starts once the memory holds more than a round of samples
+    rounds = len([step for step in range(4, 41, 4) if step > agent.update_batch_size])
+    if fuse:
+        assert batch_sizes == [24] * rounds
+    else:
+        assert batch_sizes == [8] * 3 * rounds
+
+    with pytest.raises(ValueError):
+        make_agent(env, train_every=0)
+
+
+
+def test_close_stops_prefetcher():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 2}), radius=2)
+    agent = make_agent(env, prefetch_batches=2)
+    states = env.reset()
+    for _ in range(2):
+        for step in range(20):
+            next_states, rewards, dones, _, _ = env.step({0: 0, 1: 0})
+            agent.learn(states[0], 0, rewards[0], next_states[0], False)
+            states = next_states
+        thread = agent.prefetcher.thread
+        agent.close()
+        assert agent.prefetcher is None and not thread.is_alive()  # Prefetching again on the next round
+
+
+def test_greedy_agent_cache():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 20}), radius=2)
+    states = env.reset()
+    agent = make_agent(env, cache_size=100)
+    keys = list(states.keys())
+    agent.is_greedy = True
+    expected = agent.act_batch([states[key] for key in keys], keys)
+    assert agent.cached_qnetwork.lookups == 20
+    assert agent.act_batch([states[key] for key in keys], keys) == expected
+    assert agent.cached_qnetwork.hits >= 20
+    assert agent.act(states[0]) == expected[0]
+
+    # Exploring agents do not use the cache
+    agent.is_greedy = False
+    agent.act_batch([states[key] for key in keys], keys)
+    assert agent.cached_qnetwork.lookups == 41
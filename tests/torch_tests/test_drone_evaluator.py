@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import pytest
 from drone_evaluator import DroneRacerEvaluator
@@ -31,6 +33,76 @@ def test_evaluate_baseline(model_path, expected_score, expected_secondary):
     assert np.isclose(result["score_secondary"], expected_secondary)
 
 
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_early_stopping(num_workers):
+    model_path, expected_score, _ = TEST_CASES[2]
+    evaluator = DroneRacerEvaluator(
+        num_workers=num_workers, early_stopping_confidence=0.95, early_stopping_half_width=10)
+    result = evaluator._evaluate({
+        "submission_file_path": model_path,
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert result["episodes"] == 6
+    assert result["steps_saved"] == 4 * evaluator.TOTAL_EPISODE_STEPS
+    low, high = result["score_interval"]
+    assert high - low <= 2 * 10
+    assert low < result["score"] < high
+    assert low < expected_score < high
+
+
+def test_evaluate_compiled_models():
+    model_path, expected_score, expected_secondary = TEST_CASES[0]
+    evaluator = DroneRacerEvaluator(compile_models='script')
+    result = evaluator._evaluate({
+        "submission_file_path": model_path,
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert np.isclose(result["score"], expected_score)
+    assert np.isclose(result["score_secondary"], expected_secondary)
+
+
+def test_quantized_models_checked_against_fp32():
+    model_path, expected_score, expected_secondary = TEST_CASES[0]
+    # No quantized model can reach the agreement threshold, all of them fall back to fp32
+    evaluator = DroneRacerEvaluator(quantize_models=True, quantize_min_agreement=1.01)
+    assert evaluator.get_reference_states().shape == (2 * 100 * 6, 7, 7, 6)
+    result = evaluator._evaluate({
+        "submission_file_path": model_path,
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert np.isclose(result["score"], expected_score)
+    assert np.isclose(result["score_secondary"], expected_secondary)
+
+
+def test_parallel_episodes_match_sequential():
+    model_path, expected_score, expected_secondary = TEST_CASES[2]
+    evaluator = DroneRacerEvaluator(num_workers=2)
+    result = evaluator._evaluate({
+        "submission_file_path": model_path,
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert result["score"] == expected_score
+    assert result["score_secondary"] == expected_secondary
+    # Only the first episode records, its frames are streamed to the videos
+    assert sorted(os.listdir(evaluator.video_directory_path)) == ['out.mp4', 'out_thumb.mp4']
+
+
+def test_batched_inference_scores():
+    model_path, expected_score, expected_secondary = TEST_CASES[4]
+    evaluator = DroneRacerEvaluator(batched_inference=True)
+    result = evaluator._evaluate({
+        "submission_file_path": model_path,
+        "aicrowd_submission_id": 1123,
+        "aicrowd_participant_id": 1234
+    })
+    assert np.isclose(result["score"], expected_score)
+    assert np.isclose(result["score_secondary"], expected_secondary)
+
+
 if __name__ == "__main__":
     for test_case in TEST_CASES:
         test_evaluate_baseline(test_case[0], test_case[1], test_case[2])
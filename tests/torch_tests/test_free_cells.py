@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pytest
+
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.free_cells import FreeCellIndex
+
+
+def free_set(index):
+    return set(index.cells[:index.size].tolist())
+
+
+def test_free_cell_index_matches_set():
+    rng = np.random.RandomState(0)
+    side_size = 12
+    occupied = np.sort(rng.choice(side_size ** 2, 50, replace=False))
+    index = FreeCellIndex(side_size, occupied)
+    expected = set(range(side_size ** 2)) - set(occupied.tolist())
+    assert free_set(index) == expected
+
+    for _ in range(200):
+        op = rng.randint(4)
+        if op == 0 and expected:
+            cell = int(rng.choice(sorted(expected)))
+            index.remove(cell)
+            expected.discard(cell)
+        elif op == 1:
+            cell = int(rng.randint(side_size ** 2))
+            index.add(cell)
+            expected.add(cell)
+        elif op == 2:
+            cells = rng.choice(sorted(expected), min(len(expected), rng.randint(10)), replace=False)
+            index.remove_many(cells)
+            expected -= set(cells.tolist())
+        else:
+            taken = sorted(set(range(side_size ** 2)) - expected)
+            cells = rng.choice(taken, min(len(taken), rng.randint(10)), replace=False)
+            index.add_many(cells)
+            expected |= set(cells.tolist())
+        assert free_set(index) == expected
+        assert all(index.slots[index.cells] == np.arange(side_size ** 2))
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+def test_free_cells_follow_env(engine):
+    env = DeliveryDrones({'n_drones': 50, 'respawn_sampler': 'index'}, engine=engine)
+    random.seed(0)
+    env.reset()
+    actions_rng = np.random.RandomState(0)
+    all_cells = set(range(env.side_size ** 2))
+    for _ in range(100):
+        env.step(dict(enumerate(actions_rng.randint(0, 5, size=env.n_drones).tolist())))
+        ground = [*env.skyscrapers, *env.packets, *env.dropzones, *env.stations]
+        assert free_set(env.ground_cells) == all_cells - set(env._cells(ground).tolist())
+        assert free_set(env.drone_cells) == all_cells - set(env._cells([*env.drones, *env.skyscrapers]).tolist())
+
+
+def test_no_free_cell_raises():
+    index = FreeCellIndex(2, np.arange(4))
+    with pytest.raises(ValueError, match="No free cell"):
+        index.pop()
+
+    env = DeliveryDrones({'n_drones': 1})
+    full_grid = {(y, x): True for y in range(env.side_size) for x in range(env.side_size)}
+    with pytest.raises(ValueError, match="No free cell"):
+        env._find_respawn_position(full_grid)
@@ -0,0 +1,85 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+from torch_impl.agents.event_file import crc32c, masked_crc32c
+from torch_impl.agents.logging import AggregatingLogger, Logger, TensorBoardLogger
+
+
+class RecordingLogger(Logger):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def log_dict(self, global_step, values):
+        self.records.append((global_step, values))
+
+
+def test_aggregating_logger_means():
+    recorder = RecordingLogger()
+    logger = AggregatingLogger(recorder, interval=10)
+    for step in range(25):
+        values = {'loss': torch.tensor(float(step))}
+        if step % 5 == 0:
+            values['episode_reward'] = step
+        logger.log_dict(step, values)
+    logger.flush()
+    assert recorder.records == [
+        (10, {'loss': 5.0, 'episode_reward': 5.0}),
+        (21, {'loss': 16.0, 'episode_reward': 17.5}),
+        (24, {'loss': 23.0}),  # flushed
+    ]
+    logger.log_dict(25, {'loss': torch.tensor(4.0)})
+    logger.close()
+    assert recorder.records[3:] == [(25, {'loss': 4.0})]
+    assert not logger.thread.is_alive()
+
+    with pytest.raises(ValueError):
+        AggregatingLogger(recorder, interval=0)
+
+
+def read_records(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    records = []
+    while data:
+        length_bytes, (length_crc,) = data[:8], struct.unpack('<I', data[8:12])
+        (length,) = struct.unpack('<Q', length_bytes)
+        record, (record_crc,) = data[12:12 + length], struct.unpack('<I', data[12 + length:16 + length])
+        assert length_crc == masked_crc32c(length_bytes) and record_crc == masked_crc32c(record)
+        records.append(record)
+        data = data[16 + length:]
+    return records
+
+
+def test_tensorboard_logger_event_file(tmp_path):
+    assert crc32c(b'123456789') == 0xE3069283
+    logger = TensorBoardLogger(str(tmp_path), 'run')
+    logger.log_dict(5, {'dqn/loss': torch.tensor(1.5), 'episode_reward': -2})
+    logger.log_histogram(6, 'weights', np.arange(10.0), bins=5)
+    logger.close()
+    assert 'tensorflow' not in sys.modules
+
+    (filename,) = os.listdir(tmp_path / 'run')
+    assert filename.startswith('events.out.tfevents.')
+    version, scalars, histogram = read_records(tmp_path / 'run' / filename)
+    assert b'brain.Event:2' in version
+    assert b'\x10\x05' in scalars  # step
+    assert b'dqn/loss\x15' + struct.pack('<f', 1.5) in scalars
+    assert b'episode_reward\x15' + struct.pack('<f', -2) in scalars
+    assert b'weights' in histogram and np.full(5, 2.0).astype('<f8').tobytes() in histogram  # bucket counts
+
+
+def test_tensorboard_loggers_sharing_a_log_dir(tmp_path):
+    loggers = [TensorBoardLogger(str(tmp_path), 'run') for _ in range(2)]
+    for logger, tag in zip(loggers, ['a', 'b']):
+        logger.log_dict(1, {tag: 1.0})
+        logger.close()
+    filenames = sorted(os.listdir(tmp_path / 'run'))
+    assert len(filenames) == 2
+    scalars = [read_records(tmp_path / 'run' / filename)[1] for filename in filenames]
+    assert sorted(tag for tag in [b'a', b'b'] for records in scalars if tag + b'\x15' in records) == [b'a', b'b']
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+import torch
+
+from torch_impl.agents.dqn import (
+    CachedQNetwork, CompiledQNetwork, ConvQNetworkFactory, DQNAgent, DenseQNetworkFactory, GroupedQNetworks,
+    load_qnetwork, network_obs_shape)
+from torch_impl.agents.quantization import argmax_agreement, quantize_qnetwork
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView, encode_compact
+
+
+@pytest.mark.parametrize("factory_class,factory_params", [
+    (DenseQNetworkFactory, {"hidden_layers": (16,)}),
+    (ConvQNetworkFactory, {"conv_layers": ({'out_channels': 4, 'kernel_size': 3, 'stride': 1, 'padding': 1},)}),
+])
+def test_compact_states(factory_class, factory_params):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 10}), radius=2, compact=True)
+    assert env.observation_space.shape == (5, 5, 2)
+    obs_shape = network_obs_shape(env.observation_space)
+    assert obs_shape == (5, 5, 6)
+
+    network, _ = factory_class(obs_shape, (env.action_space.n,), **factory_params).create_qnetwork()
+    states = WindowedGridView(DeliveryDrones({'n_drones': 10}), radius=2).reset()
+    states = [states[index] for index in range(10)]
+    with torch.no_grad():
+        expected = network(states)
+        actual = network([encode_compact(state) for state in states])
+    assert torch.equal(expected, actual)
+
+
+@pytest.mark.parametrize("factory_class,factory_params", [
+    (DenseQNetworkFactory, {"hidden_layers": (16,)}),
+    (ConvQNetworkFactory, {"conv_layers": ({'out_channels': 4, 'kernel_size': 3, 'stride': 1, 'padding': 1},)}),
+])
+def test_compiled_qnetwork(tmp_path, factory_class, factory_params):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 10}), radius=2)
+    states = env.reset()
+    states = np.stack([states[index] for index in range(10)])
+    network, _ = factory_class(env.observation_space.shape, (env.action_space.n,), **factory_params).create_qnetwork()
+    compiled = CompiledQNetwork.from_qnetwork(network)
+    assert compiled.state_dict().keys() == network.state_dict().keys()
+    with torch.no_grad():
+        expected = network(states)
+        # Batch sizes can take different kernels, outputs near zero differ by more than rtol
+        assert torch.allclose(compiled(states), expected, atol=1e-6)
+        assert torch.allclose(compiled(states[:3]), expected[:3], atol=1e-6)  # reuses the input buffer
+        assert torch.allclose(compiled([encode_compact(state) for state in states]), expected, atol=1e-6)
+
+    path = str(tmp_path / 'qnetwork.pt')
+    compiled.save(path)
+    with torch.no_grad():
+        assert torch.allclose(load_qnetwork(path)(states), expected)
+
+
+def test_compiled_agent_learns():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 2}), radius=2)
+    factory = DenseQNetworkFactory(env.observation_space.shape, (env.action_space.n,), hidden_layers=(16,))
+    agents = [
+        DQNAgent(env=env, dqn_factory=factory, gamma=0.95, epsilon_start=1.0, epsilon_decay=0.99, epsilon_end=0.01,
+                 memory_size=1000, batch_size=8, target_update_interval=4, compile=compile)
+        for compile in [None, 'script']]
+    for agent in agents:
+        agent.qnetwork.load_state_dict(agents[0].qnetwork.state_dict())
+        agent.target_qnetwork.load_state_dict(agents[0].target_qnetwork.state_dict())
+
+    states = env.reset()
+    for step in range(20):
+        next_states, rewards, dones, _, _ = env.step({0: step % 5, 1: 0})
+        for agent in agents:
+            np.random.seed(step)
+            agent.learn(states[0], step % 5, rewards[0], next_states[0], dones[0])
+        states = next_states
+    eager, scripted = [agent.qnetwork.state_dict() for agent in agents]
+    assert all(torch.allclose(eager[key], scripted[key], atol=1e-6) for key in eager)
+
+
+@pytest.mark.parametrize("factory_class,factory_params", [
+    (DenseQNetworkFactory, {"hidden_layers": (16,)}),
+    (ConvQNetworkFactory, {"conv_layers": ({'out_channels': 4, 'kernel_size': 3, 'stride': 1, 'padding': 1},)}),
+])
+def test_quantized_qnetwork(factory_class, factory_params):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 20}), radius=2)
+    states = env.reset()
+    states = np.stack([states[index] for index in range(20)])
+    network, _ = factory_class(env.observation_space.shape, (env.action_space.n,), **factory_params).create_qnetwork()
+    quantized = quantize_qnetwork(network, states)
+    assert not any(isinstance(module, torch.nn.Linear) for module in quantized.network.modules())
+    with torch.no_grad():
+        assert quantized(states).shape == network(states).shape
+    assert 0.0 <= argmax_agreement(quantized, network, states) <= 1.0
+    assert argmax_agreement(network, network, states) == 1.0
+
+    with pytest.raises(ValueError):
+        quantize_qnetwork(CompiledQNetwork.from_qnetwork(network), states)
+
+
+def test_cached_qnetwork():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 10}), radius=2)
+    states = env.reset()
+    states = np.stack([states[index] for index in range(10)])
+    network, optimizer = DenseQNetworkFactory(
+        env.observation_space.shape, (env.action_space.n,), hidden_layers=(16,)).create_qnetwork()
+    batch_sizes = []
+    network.register_forward_hook(lambda module, inputs, output: batch_sizes.append(len(output)))
+    cached = CachedQNetwork(network, capacity=12)
+
+    batch = states[[0, 1, 0, 2, 1]]
+    with torch.no_grad():
+        expected = network(batch)
+    assert torch.allclose(cached(batch), expected)
+    assert batch_sizes[-1] == 3 and cached.hits == 2 and len(cached.cache) == 3
+    assert all(values.untyped_storage().nbytes() == values.nbytes for values in cached.cache.values())  # Own rows
+    assert torch.allclose(cached(states), network(states).detach())
+    assert batch_sizes[-2] == 7 and cached.hit_rate == 5 / 15
+
+    # Least recently used observations are evicted first
+    cached(states + 1)
+    assert len(cached.cache) == 12
+    assert states[0].tobytes() not in cached.cache and states[9].tobytes() in cached.cache
+
+    # Parameter updates invalidate the cache
+    loss = network(states).sum()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    assert torch.allclose(cached(states), network(states).detach())
+    assert len(cached.cache) == 10
+
+
+def test_grouped_qnetworks():
+    env = WindowedGridView(DeliveryDrones({'n_drones': 8}), radius=2)
+    states = env.reset()
+    states = np.stack([states[index] for index in range(8)])
+    obs_shape, action_shape = env.observation_space.shape, (env.action_space.n,)
+    conv_layers = ({'out_channels': 4, 'kernel_size': 3, 'stride': 1, 'padding': 1},)
+    dense_factory = DenseQNetworkFactory(obs_shape, action_shape, hidden_layers=(16, 8))
+    dense = [dense_factory.create_qnetwork()[0] for _ in range(3)]
+    conv = [ConvQNetworkFactory(obs_shape, action_shape, conv_layers, (8,)).create_qnetwork()[0] for _ in range(2)]
+    tanh = [dense_factory.create_qnetwork()[0] for _ in range(2)]
+    for network in tanh:
+        network.network.dense_act_1 = torch.nn.Tanh()  # Stacked with vmap
+    qnetworks = [
+        dense[0], conv[0], tanh[0], dense[1], CompiledQNetwork.from_qnetwork(dense[2]), conv[1], tanh[1], dense[2]]
+
+    grouped = GroupedQNetworks(qnetworks)
+    assert sorted(indices.tolist() for indices, _ in grouped.groups) == [[0, 3, 7], [1, 5], [2, 6], [4]]
+    with torch.no_grad():
+        expected = torch.cat([network(states[[index]]) for index, network in enumerate(qnetworks)])
+        assert torch.allclose(grouped(states), expected, atol=1e-6)
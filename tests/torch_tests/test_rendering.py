@@ -6,6 +6,7 @@ import os
 from torch_impl.env.env import DeliveryDrones
 from torch_impl.agents.random import RandomAgent
 from common.render import Renderer
+from common.video import VideoEncoder
 from torch_impl.render_util import convert_for_rendering
 def test_rendering(tmp_path):
     env_params = {'n_drones': 6}
@@ -40,6 +41,28 @@ def test_rendering(tmp_path):
         assert os.path.exists(output_path)
 
 
+def test_streaming_video(tmp_path):
+    env = DeliveryDrones({'n_drones': 3})
+    env.reset()
+    renderer = Renderer(env.n_drones, env.side_size, resolution_scale_factor=2.0)
+    renderer.init()
+    outputs = [(str(tmp_path / 'out.mp4'), (600, 600)), (str(tmp_path / 'out_thumb.mp4'), (320, 320))]
+    with VideoEncoder(outputs, fps=7) as video:
+        for step in range(20):
+            actions = {index: step % 5 for index in range(env.n_drones)}
+            _, rewards, _, _, _ = env.step(actions)
+            ground, air, carrying_package, charge = convert_for_rendering(env)
+            video.write(renderer.render_frame(ground, air, carrying_package, charge, rewards, actions))
+        with pytest.raises(ValueError):
+            video.write(np.zeros((10, 10, 3), dtype=np.uint8))
+    assert sorted(os.listdir(tmp_path)) == ['out.mp4', 'out_thumb.mp4']
+    assert all(os.path.getsize(path) > 0 for path, _ in outputs)
+
+    with pytest.raises(Exception):
+        with VideoEncoder([(str(tmp_path / 'missing' / 'out.mp4'), None)]) as video:
+            video.write(np.zeros((16, 16, 3), dtype=np.uint8))
+
+
 if __name__ == "__main__":
     tmp_dir = tempfile.mkdtemp()
     test_rendering(tmp_dir)
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import torch
+
+from torch_impl.agents.buffers import BatchPrefetcher, ReplayMemory
+
+
+def transition(step, start=0):
+    """Transition step of an episode, states are their step number"""
+    state = np.full(3, start + step, dtype=np.float32)
+    next_state = np.full(3, start + step + 1, dtype=np.float32)
+    return state, step % 5, float(step), next_state, step % 7 == 0
+
+
+def check_sample(memory, batch_size):
+    states, actions, rewards, next_states, dones = memory.sample(batch_size)
+    assert len(set(rewards.tolist())) == batch_size
+    steps = rewards.astype(np.int64)
+    assert np.array_equal(actions, steps % 5)
+    assert np.array_equal(dones, steps % 7 == 0)
+    assert np.array_equal(next_states, states + 1)
+    return steps
+
+
+def test_contiguous_states_stored_once():
+    memory = ReplayMemory(100)
+    for step in range(50):
+        memory.append(*transition(step))
+    assert len(memory) == 50
+    assert memory.filled == 51
+    check_sample(memory, 50)
+    with pytest.raises(ValueError):
+        memory.sample(51)
+
+
+def test_wrap_around_keeps_latest():
+    memory = ReplayMemory(20)
+    memory.initial_slots = 4  # grows a few times before wrapping around
+    for step in range(95):
+        memory.append(*transition(step))
+    assert len(memory) == 20
+    assert sorted(check_sample(memory, 20).tolist()) == list(range(75, 95))
+    assert sorted(reward for _, _, reward, _, _ in memory) == list(range(75, 95))
+
+
+def test_non_contiguous_transitions():
+    memory = ReplayMemory(30)
+    for step in range(40):
+        # Every transition starts from a new state, taking two slots
+        memory.append(*transition(step, start=1000 * step))
+    assert len(memory) == 15
+    assert sorted(check_sample(memory, 15).tolist()) == list(range(25, 40))
+
+
+def test_streams_chain_separately():
+    memory = ReplayMemory(60, num_streams=3)
+    for step in range(30):
+        # Each stream runs its own episode, drones 0 and 2 append every step
+        streams = [0, 2] if step % 2 else [0, 1, 2]
+        batch = [transition(step, start=1000 * stream) for stream in streams]
+        memory.append_batch(*map(list, zip(*batch)), streams=streams)
+    assert memory.slots == 21
+    # Stream 1 skips steps so each of its transitions takes two slots
+    assert len(memory) == 20 + 10 + 20
+    states, actions, rewards, next_states, dones = memory.sample(50)
+    assert np.array_equal(next_states, states + 1)
+    assert np.array_equal(actions, rewards.astype(np.int64) % 5)
+
+
+def test_prefetcher_batches():
+    memory = ReplayMemory(100)
+    for step in range(50):
+        memory.append(*transition(step))
+    prefetcher = BatchPrefetcher(memory, 16, 'cpu', num_batches=2)
+    try:
+        for _ in range(5):
+            states, actions, rewards, next_states, dones = prefetcher.get()
+            assert isinstance(states, torch.Tensor) and states.shape == (16, 3)
+            steps = rewards.long()
+            assert torch.equal(actions, steps % 5)
+            assert torch.equal(next_states, states + 1)
+            memory.append(*transition(50))
+    finally:
+        prefetcher.close()
+
+
+def test_prefetcher_rng():
+    memory = ReplayMemory(100)
+    for step in range(50):
+        memory.append(*transition(step))
+    batches = []
+    for _ in range(2):
+        np.random.seed(0)
+        prefetcher = BatchPrefetcher(memory, 16, 'cpu', num_batches=2)
+        try:
+            batches.append([prefetcher.get()[2] for _ in range(5)])
+        finally:
+            prefetcher.close()
+        # Only the seed of the prefetcher is drawn from the global stream
+        after_prefetcher = np.random.rand()
+        np.random.seed(0)
+        np.random.randint(2 ** 32, dtype=np.uint64)
+        assert after_prefetcher == np.random.rand()
+    assert all(torch.equal(first, second) for first, second in zip(*batches))
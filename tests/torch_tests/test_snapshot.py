@@ -0,0 +1,53 @@
+import copy
+import random
+
+import numpy as np
+import pytest
+
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView
+
+
+def run_steps(env, actions):
+    trace = []
+    for step_actions in actions:
+        states, rewards, dones, _, _ = env.step(dict(enumerate(step_actions.tolist())))
+        trace.append((
+            {index: state.tobytes() for index, state in states.items()}, rewards, dones,
+            [(position, drone.index, drone.charge, drone.packet) for position, drone in env.drones.items()],
+            sorted(env.packets), sorted(env.dropzones),
+        ))
+    return trace
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+@pytest.mark.parametrize("respawn_sampler", ['rejection', 'index'])
+def test_restore_replays_episode(engine, respawn_sampler):
+    env = WindowedGridView(DeliveryDrones(
+        {'n_drones': 30, 'drone_density': 0.1, 'respawn_sampler': respawn_sampler}, engine=engine), radius=2)
+    random.seed(0)
+    env.reset()
+    actions = np.random.RandomState(0).randint(0, 5, size=(60, env.n_drones))
+    run_steps(env, actions[:20])
+
+    snapshot = env.snapshot()
+    assert not snapshot.positions.flags.writeable
+    expected = run_steps(env, actions[20:])
+    random.seed(123)  # restore brings the RNGs back too
+    env.restore(snapshot)
+    assert run_steps(env, actions[20:]) == expected
+
+    # The snapshot is not affected by the steps that followed
+    env.restore(snapshot)
+    assert run_steps(env, actions[20:40]) == expected[:20]
+
+
+def test_snapshot_is_compact():
+    env = DeliveryDrones({'n_drones': 30})
+    snapshot = env.snapshot()
+    assert len(snapshot.order) == 30
+    assert [len(cells) for cells in snapshot.objects] == [len(env.packets), len(env.dropzones),
+                                                          len(env.stations), len(env.skyscrapers)]
+    restored = copy.copy(env)
+    restored.restore(snapshot)
+    assert list(restored.drones) == list(env.drones)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from common.stats import RunningStats, t_quantile
+
+
+@pytest.mark.parametrize("p,df,expected", [
+    (0.975, 1, 12.706204736174694),
+    (0.975, 2, 4.302652729749462),
+    (0.995, 4, 4.604094871349992),
+    (0.975, 9, 2.262157162798205),
+    (0.025, 9, -2.262157162798205),
+])
+def test_t_quantile(p, df, expected):
+    assert np.isclose(t_quantile(p, df), expected)
+
+
+def test_running_stats():
+    values = np.random.default_rng(0).normal(size=(10, 3))
+    stats = RunningStats()
+    assert np.all(np.isinf(stats.half_width(0.95)))
+    for value in values:
+        stats.add(value)
+    assert np.allclose(stats.mean, values.mean(axis=0))
+    assert np.allclose(stats.variance, values.var(axis=0, ddof=1))
+    assert np.allclose(stats.half_width(0.95), 2.262157162798205 * values.std(axis=0, ddof=1) / np.sqrt(10))
@@ -0,0 +1,51 @@
+import random
+
+import numpy as np
+
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.vec_env import SubprocVecDeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView
+
+ENV_PARAMS = {'n_drones': 10, 'drone_density': 0.1}
+
+
+def test_matches_single_envs():
+    seeds = [3, 4, 5]
+    rng = np.random.RandomState(0)
+    actions = rng.randint(0, 5, size=(20, len(seeds), ENV_PARAMS['n_drones']))
+
+    # One world per worker: each one seeds random with its own seed
+    expected = []
+    for world, seed in enumerate(seeds):
+        env = WindowedGridView(DeliveryDrones(ENV_PARAMS, engine='array'), radius=2)
+        random.seed(seed)
+        env.reset(seed=seed)
+        trace = []
+        for step_actions in actions[:, world]:
+            states, rewards, dones, _, _ = env.step(dict(enumerate(step_actions.tolist())))
+            trace.append((np.stack([states[index] for index in range(len(states))]),
+                          [rewards[index] for index in range(len(rewards))],
+                          [dones[index] for index in range(len(dones))]))
+        expected.append(trace)
+
+    with SubprocVecDeliveryDrones(
+            len(seeds), ENV_PARAMS, radius=2, num_workers=len(seeds), seeds=seeds) as vec_env:
+        for step, step_actions in enumerate(actions):
+            vec_env.step_async(step_actions)
+            states, rewards, dones, truncated, _ = vec_env.step_wait()
+            assert states.shape == (len(seeds), ENV_PARAMS['n_drones'], 5, 5, 6)
+            assert not truncated.any()
+            for world, trace in enumerate(expected):
+                assert np.array_equal(states[world], trace[step][0])
+                assert rewards[world].tolist() == trace[step][1]
+                assert dones[world].tolist() == trace[step][2]
+
+
+def test_auto_reset():
+    with SubprocVecDeliveryDrones(3, ENV_PARAMS, num_workers=2, max_episode_steps=2, seeds=0) as vec_env:
+        actions = np.full((3, ENV_PARAMS['n_drones']), 4)
+        _, _, _, truncated, info = vec_env.step(actions)
+        assert not truncated.any() and 'final_observation' not in info
+        states, _, _, truncated, info = vec_env.step(actions)
+        assert truncated.all()
+        assert info['final_observation'].shape == states.shape
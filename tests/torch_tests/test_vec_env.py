@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from common.constants import Object
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.vec_env import VecDeliveryDrones
+from torch_impl.env.wrappers import WindowedGridView
+
+ENV_PARAMS = {'n_drones': 20, 'drone_density': 0.1}
+
+
+def world_as_env(vec_env, world):
+    """ArrayDeliveryDrones holding a copy of one world of vec_env"""
+    env = DeliveryDrones(vec_env.env_params, engine='array')
+    env.ground = vec_env.ground[world].copy()
+    env.air = vec_env.air[world].copy()
+    env.positions = vec_env.positions[world].copy()
+    env.charge = vec_env.charge[world].copy()
+    env.packet = vec_env.packet[world].copy()
+    env.order = np.argsort(vec_env.rank[world])
+    return env
+
+
+def test_world_seeds():
+    vec_env = VecDeliveryDrones(3, ENV_PARAMS, seeds=[4, 5, 6])
+    for world, seed in enumerate([4, 5, 6]):
+        single = VecDeliveryDrones(1, ENV_PARAMS, seeds=[seed])
+        assert np.array_equal(vec_env.ground[world], single.ground[0])
+        assert np.array_equal(vec_env.positions[world], single.positions[0])
+    with pytest.raises(ValueError):
+        vec_env.reset(seeds=[1, 2])
+
+
+def test_step_matches_array_engine():
+    vec_env = VecDeliveryDrones(4, ENV_PARAMS, seeds=0)
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        actions = rng.randint(0, 5, size=(vec_env.num_envs, vec_env.n_drones))
+        envs = [WindowedGridView(world_as_env(vec_env, world), radius=3) for world in range(vec_env.num_envs)]
+        states, rewards, dones, truncated, _ = vec_env.step(actions)
+        assert states.shape == (vec_env.num_envs, vec_env.n_drones, 7, 7, 6)
+        assert not truncated.any()
+
+        for world, env in enumerate(envs):
+            _, env_rewards, env_dones, _, _ = env.step(actions[world])
+            assert rewards[world].tolist() == [env_rewards[index] for index in range(vec_env.n_drones)]
+            assert dones[world].tolist() == [env_dones[index] for index in range(vec_env.n_drones)]
+
+            # Same windows once the respawns of the vec env are copied over
+            env_states = WindowedGridView(world_as_env(vec_env, world), radius=3).observation(None)
+            assert np.array_equal(states[world], np.stack([env_states[index] for index in range(vec_env.n_drones)]))
+
+        # Grids stay consistent with the drone state
+        worlds = np.arange(vec_env.num_envs)[:, None]
+        ys, xs = vec_env.positions[..., 0], vec_env.positions[..., 1]
+        assert (vec_env.air[worlds, ys, xs] == np.arange(vec_env.n_drones)).all()
+        assert (vec_env.air != -1).sum(axis=(1, 2)).tolist() == [vec_env.n_drones] * vec_env.num_envs
+        assert not (vec_env.ground[worlds, ys, xs] == Object.SKYSCRAPER).any()
+        packets = (vec_env.ground == Object.PACKET).sum(axis=(1, 2)) + vec_env.packet.sum(axis=1)
+        assert (packets == vec_env.counts[1]).all()
+
+
+def test_auto_reset():
+    vec_env = VecDeliveryDrones(2, ENV_PARAMS, max_episode_steps=3, seeds=[0, 1])
+    first_layout = vec_env.ground.copy()
+    actions = np.full((2, vec_env.n_drones), 4)
+    for _ in range(2):
+        _, _, _, truncated, info = vec_env.step(actions)
+        assert not truncated.any() and 'final_observation' not in info
+    states, _, _, truncated, info = vec_env.step(actions)
+    assert truncated.all()
+    assert info['final_observation'].shape == states.shape
+    assert vec_env.steps.tolist() == [0, 0]
+    assert not np.array_equal(vec_env.ground, first_layout)
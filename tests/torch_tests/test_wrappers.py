@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from torch_impl.agents.dqn import decode_compact
+from torch_impl.env.env import DeliveryDrones
+from torch_impl.env.wrappers import GridView, WindowedGridView, encode_compact
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+def test_incremental_grid_matches_rebuild(engine):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 30, 'drone_density': 0.1}, engine=engine), radius=2)
+    random.seed(0)
+    env.reset()
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        env.step(dict(enumerate(rng.randint(0, 5, size=env.n_drones).tolist())))
+        assert np.array_equal(env.padded_grid, env._build_grid())
+
+
+def run_states(engine, n_steps, **kwargs):
+    env = WindowedGridView(DeliveryDrones({'n_drones': 30, 'drone_density': 0.1}, engine=engine), radius=2, **kwargs)
+    random.seed(0)
+    states = [env.reset()]
+    rng = np.random.RandomState(0)
+    for _ in range(n_steps):
+        states.append(env.step(dict(enumerate(rng.randint(0, 5, size=env.n_drones).tolist())))[0])
+        if not kwargs.get('copy', True):
+            assert states[-1] is states[0] and not states[-1].flags.writeable
+            states[-1] = states[-1].copy()
+    return states
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+@pytest.mark.parametrize("copy", [True, False])
+def test_array_mode_matches_dict(engine, copy):
+    dict_states = run_states(engine, 50)
+    array_states = run_states(engine, 50, as_array=True, copy=copy)
+    for expected, actual in zip(dict_states[1:], array_states[1:]):
+        assert actual.shape == (30, 5, 5, 6)
+        assert np.array_equal(np.stack([expected[index] for index in range(30)]), actual)
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+def test_shared_grid_view(engine):
+    env_params = {'n_drones': 10, 'drone_density': 0.1}
+    env = GridView(DeliveryDrones(env_params, engine=engine))
+    shared_env = GridView(DeliveryDrones(env_params, engine=engine), shared=True)
+    rng = np.random.RandomState(0)
+    for wrapper in [env, shared_env]:
+        random.seed(0)
+        wrapper.reset()
+    previous_states = None
+    for _ in range(20):
+        actions = dict(enumerate(rng.randint(0, 5, size=10).tolist()))
+        random_state = random.getstate()
+        states = env.step(actions)[0]
+        random.setstate(random_state)
+        shared_states = shared_env.step(actions)[0]
+
+        if previous_states is not None:  # States are not updated by later steps
+            assert np.array_equal(previous_states.positions, previous_positions)
+        previous_states, previous_positions = shared_states, shared_states.positions.copy()
+        assert sorted(shared_states) == sorted(states)
+        assert all(shared_states[index] is shared_states.grid for index in shared_states)
+        assert not shared_states.grid.flags.writeable
+        assert np.array_equal(shared_states.grid, states[0])
+        for (y, x), drone in shared_env.drones.items():
+            assert tuple(shared_states.positions[drone.index]) == (y, x)
+            assert shared_states.charge[drone.index] == drone.charge / 100
+
+
+@pytest.mark.parametrize("engine", ['dict', 'array'])
+@pytest.mark.parametrize("as_array", [False, True])
+def test_compact_observations(engine, as_array):
+    states = run_states(engine, 30, as_array=as_array)
+    compact_states = run_states(engine, 30, as_array=as_array, compact=True)
+    for expected, actual in zip(states, compact_states):
+        for index in range(30):
+            assert actual[index].dtype == np.uint8 and actual[index].shape == (5, 5, 2)
+            decoded = decode_compact(torch.tensor(actual[index])).numpy()
+            assert np.array_equal(decoded, expected[index])
+            assert np.array_equal(actual[index], encode_compact(expected[index]))
+
+
+def test_compact_charge_roundtrip():
+    grid = np.zeros((101, 6), dtype=np.float32)
+    grid[:, 4] = np.arange(101) / 100
+    assert np.array_equal(decode_compact(torch.tensor(encode_compact(grid))).numpy(), grid)
@@ -0,0 +1,182 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class ReplayMemory:
+    """
+    Replay memory of (state, action, reward, next_state, done) transitions in NumPy arrays
+
+    Transitions live in a ring of slots: slot i holds the state, action, reward and done of a
+    transition and its next_state is the state of slot i + 1. When a transition starts from the
+    next_state of the previous one, which is the case along an episode, its state is not stored
+    again. Otherwise a slot is left holding only the previous next_state.
+
+    With num_streams > 1, every stream (e.g. each drone of a shared policy) has its own ring
+    along the first axis of the arrays and append_batch adds one transition to many streams.
+    Sampling draws from all streams.
+
+    Arrays take the shape and dtype of the first state and double in size as they fill up,
+    so a large capacity only costs memory once it is used.
+    """
+    initial_slots = 1024
+
+    def __init__(self, capacity, num_streams=1):
+        self.capacity = capacity
+        self.num_streams = num_streams
+        self.slots = -(-capacity // num_streams) + 1  # per stream
+        self.states = None
+        self.actions = np.zeros((0, num_streams), dtype=np.int64)
+        self.rewards = np.zeros((0, num_streams), dtype=np.float32)
+        self.dones = np.zeros((0, num_streams), dtype=bool)
+        self.valid = np.zeros((0, num_streams), dtype=bool)  # slots holding a transition
+        self.size = 0  # number of valid slots
+        self.filled = 0  # number of slots written at least once, in any stream
+        self.last = np.full(num_streams, -1, dtype=np.int64)  # slot holding the last next_state
+        self.lock = threading.Lock()  # held by appends and by BatchPrefetcher while sampling
+
+    def __len__(self):
+        return self.size
+
+    def _invalidate(self, slots, streams):
+        self.size -= np.count_nonzero(self.valid[slots, streams])
+        self.valid[slots, streams] = False
+
+    def _reserve(self, slots):
+        # Slots are filled in order before wrapping around, so growing keeps slot numbers
+        if slots <= len(self.valid):
+            return
+        size = min(self.slots, max(self.initial_slots, 2 * len(self.valid), slots))
+
+        def grown(array):
+            new = np.zeros((size, *array.shape[1:]), dtype=array.dtype)
+            new[:len(array)] = array
+            return new
+        self.states, self.actions, self.rewards, self.dones, self.valid = [
+            grown(array) for array in [self.states, self.actions, self.rewards, self.dones, self.valid]]
+
+    def append(self, state, action, reward, next_state, done, stream=0):
+        self.append_batch([state], [action], [reward], [next_state], [done], streams=[stream])
+
+    def append_batch(self, states, actions, rewards, next_states, dones, streams=None):
+        """Appends one transition to each of the distinct streams, by default 0 to len(states) - 1"""
+        states, next_states = np.asarray(states), np.asarray(next_states)
+        streams = np.arange(len(states)) if streams is None else np.asarray(streams, dtype=np.int64)
+        with self.lock:
+            if self.states is None:
+                self.states = np.zeros((0, self.num_streams, *states.shape[1:]), dtype=states.dtype)
+
+            last = self.last[streams]
+            contiguous = np.zeros(len(streams), dtype=bool)
+            chained = np.flatnonzero(last >= 0)
+            if len(chained) > 0:
+                stored = self.states[last[chained], streams[chained]]
+                contiguous[chained] = (stored == states[chained]).reshape(len(chained), -1).all(axis=1)
+
+            # Streams whose state is not their last next_state keep it and start a new chain after it
+            slots = np.where(contiguous, last, (last + 1) % self.slots)
+            next_slots = (slots + 1) % self.slots
+            self._reserve(max(slots.max(), next_slots.max()) + 1)
+            new_chain = ~contiguous
+            self._invalidate(slots[new_chain], streams[new_chain])
+            self.states[slots[new_chain], streams[new_chain]] = states[new_chain]
+            self._invalidate(next_slots, streams)  # their states are overwritten
+            self.states[next_slots, streams] = next_states
+
+            self.actions[slots, streams] = actions
+            self.rewards[slots, streams] = rewards
+            self.dones[slots, streams] = dones
+            self.valid[slots, streams] = True
+            self.size += len(streams)
+            self.last[streams] = next_slots
+            self.filled = max(self.filled, slots.max() + 1, next_slots.max() + 1)
+
+    def sample_indices(self, batch_size, rng=None):
+        """
+        Distinct valid slots drawn uniformly in O(batch_size), as flat slot * num_streams + stream
+        Draws come from the np.random.Generator rng, by default from the global np.random stream
+        """
+        if batch_size > self.size:
+            raise ValueError(f"Cannot sample {batch_size} transitions from a memory of {self.size}")
+        valid = self.valid.reshape(-1)
+        indices = np.zeros(0, dtype=np.int64)
+        while len(indices) < batch_size:
+            high, size = self.filled * self.num_streams, batch_size - len(indices)
+            draws = np.random.randint(high, size=size) if rng is None else rng.integers(high, size=size)
+            indices = np.unique(np.concatenate([indices, draws[valid[draws]]]))
+        return indices
+
+    def get(self, indices):
+        slots, streams = np.divmod(indices, self.num_streams)
+        return (
+            self.states[slots, streams],
+            self.actions[slots, streams],
+            self.rewards[slots, streams],
+            self.states[(slots + 1) % self.slots, streams],
+            self.dones[slots, streams],
+        )
+
+    def sample(self, batch_size, rng=None):
+        """Returns arrays of states, actions, rewards, next_states and dones"""
+        return self.get(self.sample_indices(batch_size, rng))
+
+    def __iter__(self):
+        for index in np.flatnonzero(self.valid):
+            state, action, reward, next_state, done = self.get(index)
+            yield state, action.item(), reward.item(), next_state, done.item()
+
+
+class BatchPrefetcher:
+    """
+    Background thread keeping a queue of ready-made training batches
+
+    Batches are sampled from the replay memory, turned into tensors (pinned when the device is
+    a GPU) and sent to the device with non_blocking=True, so the learner only dequeues them.
+    Queued batches can be a few appends older than the memory. The thread samples with a
+    generator of its own, seeded from np.random on creation, so that seeded runs do not depend
+    on how it is scheduled against the main thread.
+    """
+
+    def __init__(self, memory, batch_size, device, num_batches=2):
+        self.memory = memory
+        self.rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _to_device(self, array):
+        tensor = torch.from_numpy(array)
+        if self.device.type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                with self.memory.lock:
+                    arrays = self.memory.sample(self.batch_size, self.rng)
+                batch = tuple(self._to_device(array) for array in arrays)
+            except Exception as error:
+                batch = error
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """Returns tensors of states, actions, rewards, next_states and dones"""
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
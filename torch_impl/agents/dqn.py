@@ -1,20 +1,24 @@
 from typing import Tuple, Dict, Sequence, Optional
-from collections import defaultdict, Counter
-from collections import deque
+from collections import defaultdict, Counter, OrderedDict
 
 import gym.spaces as spaces
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch import Tensor, LongTensor
+from torch import Tensor
 import os
 from safetensors.torch import save_file, safe_open
 import ast
+import copy
+import json
 import operator as op
+import functools
 from functools import reduce
 
+from .buffers import BatchPrefetcher, ReplayMemory
 from .logging import Logger, NoLogger
 
 # Determine and store the best available device globally
@@ -31,6 +35,36 @@ if device is None:
 print(device)
 
 
+def decode_compact(states):
+    """
+    Decodes a uint8 tensor of compact observations (..., 2) into the (..., 6) float
+    observations of the wrappers, see torch_impl.env.wrappers.encode_compact
+    """
+    bits = (states[..., :1] >> torch.arange(6, dtype=torch.uint8, device=states.device)) & 1
+    decoded = bits.to(torch.float32)
+    decoded[..., 4] = states[..., 1].to(torch.float32) / 100
+    return decoded
+
+
+def states_to_tensor(states):
+    """Float tensor on device, compact uint8 states are sent as is and decoded on device"""
+    if isinstance(states, torch.Tensor):
+        states = states.to(device)
+        return decode_compact(states) if states.dtype == torch.uint8 else states.float()
+    states = np.asarray(states)
+    if states.dtype == np.uint8:
+        return decode_compact(torch.tensor(states, device=device))
+    return torch.tensor(states, dtype=torch.float32, device=device)
+
+
+def network_obs_shape(observation_space):
+    """Observation shape to build Q-networks with: compact spaces decode to 6 channels"""
+    shape = tuple(observation_space.shape)
+    if observation_space.dtype == np.uint8 and shape[-1] == 2:
+        return (*shape[:-1], 6)
+    return shape
+
+
 class QNetwork(nn.Module):
     """
     A Q-network for OpenAI Gym Environments
@@ -77,7 +111,7 @@ class DenseQNetwork(QNetwork):
         self.network.to(device)
 
     def forward(self, states):
-        states_tensor = torch.Tensor(np.array(states).reshape(-1, self.input_size)).to(device)
+        states_tensor = states_to_tensor(states).reshape(-1, self.input_size)
         return self.network(states_tensor)
 
 
@@ -153,11 +187,233 @@ class ConvQNetwork(QNetwork):
         # Convert states to tensor and rearrange dimensions
         # states input shape is [batch_size, height, width, channels]
         # we need [batch_size, channels, height, width] for PyTorch convolutions
-        states_tensor = torch.tensor(
-            np.array(states), dtype=torch.float32, device=device).permute(0, 3, 1, 2)
+        states_tensor = states_to_tensor(states).permute(0, 3, 1, 2)
         return self.network(states_tensor)
 
 
+class CompiledQNetwork(QNetwork):
+    """
+    Q-network running a TorchScript or torch.compile version of a QNetwork's layers
+    States are copied once into a preallocated input buffer laid out as the layers expect
+    (channels-first for convolutions), parameters and state_dict keys are the original ones
+    """
+    backends = ('script', 'compile')
+
+    def __init__(self, network: nn.Module, input_shape: Sequence[int], channels_first: bool, backend: str = 'script'):
+        if backend not in self.backends:
+            raise ValueError(f"Unknown backend {backend}, expected one of {self.backends}")
+        super().__init__()
+        if backend == 'script' and not isinstance(network, torch.jit.ScriptModule):
+            network = torch.jit.script(network)
+        self.network = network
+        self.run = torch.compile(network.forward) if backend == 'compile' else network.forward
+        self.input_shape = tuple(input_shape)  # Shape of one input of the layers
+        self.channels_first = channels_first  # Permute NHWC states to NCHW
+        self.backend = backend
+        self.inputs = torch.zeros((0, *self.input_shape), device=device)
+
+    @classmethod
+    def from_qnetwork(cls, qnetwork: QNetwork, backend: str = 'script'):
+        if isinstance(qnetwork, ConvQNetwork):
+            height, width, channels = qnetwork.input_shape
+            return cls(qnetwork.network, (channels, height, width), True, backend)
+        if isinstance(qnetwork, DenseQNetwork):
+            return cls(qnetwork.network, (qnetwork.input_size,), False, backend)
+        raise ValueError(f"Cannot compile {type(qnetwork).__name__}")
+
+    def forward(self, states):
+        if not isinstance(states, torch.Tensor):
+            states = torch.as_tensor(np.asarray(states))  # No copy for float32 arrays on CPU
+        if states.dtype == torch.uint8:
+            states = decode_compact(states.to(device))
+        batch_size = len(states)
+        if batch_size > len(self.inputs):
+            self.inputs = torch.empty((batch_size, *self.input_shape), device=device)
+        inputs = self.inputs[:batch_size]
+        if self.channels_first:
+            inputs.copy_(states.permute(0, 3, 1, 2))
+        else:
+            inputs.copy_(states.reshape(batch_size, *self.input_shape))
+        return self.run(inputs)
+
+    def save(self, path):
+        """Saves a TorchScript artifact loadable without the model code, see load_qnetwork"""
+        network = self.network if isinstance(self.network, torch.jit.ScriptModule) else torch.jit.script(self.network)
+        config = {'input_shape': self.input_shape, 'channels_first': self.channels_first}
+        torch.jit.save(network, path, _extra_files={'qnetwork.json': json.dumps(config)})
+
+    @classmethod
+    def load(cls, path, backend: str = 'script'):
+        extra_files = {'qnetwork.json': ''}
+        network = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        config = json.loads(extra_files['qnetwork.json'])
+        return cls(network, config['input_shape'], config['channels_first'], backend)
+
+
+class CachedQNetwork(QNetwork):
+    """
+    Inference-only Q-network memoizing the Q-values of observations
+    Identical observations of a batch are computed once and the Q-values of the last capacity
+    distinct observations are kept across calls, keyed by their bytes (compact uint8 states are
+    the most compact keys). The cache is cleared whenever the parameters are modified in-place,
+    as by optimizer steps and load_state_dict.
+    """
+
+    def __init__(self, qnetwork: nn.Module, capacity: int = 100_000):
+        if capacity < 1:
+            raise ValueError(f"Cache capacity must be positive, got {capacity}")
+        super().__init__()
+        self.qnetwork = qnetwork
+        self.capacity = capacity
+        self.cache = OrderedDict()  # Observation bytes -> Q-values, least recently used first
+        self.params_version = None
+        self.hits = 0  # Observations answered without a forward pass
+        self.lookups = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def clear(self):
+        self.cache.clear()
+
+    def forward(self, states):
+        params_version = tuple(param._version for param in self.qnetwork.parameters())
+        if params_version != self.params_version:
+            self.clear()
+            self.params_version = params_version
+
+        if isinstance(states, torch.Tensor):
+            states = states.cpu().numpy()
+        states = np.asarray(states)
+        keys = [row.tobytes() for row in states.reshape(len(states), -1)]
+
+        # Dedupe the batch, then find observations missing from the cache
+        unique_keys, first_rows = {}, []
+        inverse = np.zeros(len(keys), dtype=np.int64)
+        for row, key in enumerate(keys):
+            index = unique_keys.get(key)
+            if index is None:
+                index = unique_keys[key] = len(first_rows)
+                first_rows.append(row)
+            inverse[row] = index
+        q_values = [self.cache.get(key) for key in unique_keys]
+        missing = [index for index, values in enumerate(q_values) if values is None]
+        self.lookups += len(keys)
+        self.hits += len(keys) - len(missing)
+
+        if len(missing) > 0:
+            with torch.no_grad():
+                computed = self.qnetwork(states[[first_rows[index] for index in missing]])
+            for index, values in zip(missing, computed):
+                q_values[index] = values.clone()  # Rows of computed would keep the whole batch alive
+
+        for key, values in zip(unique_keys, q_values):
+            self.cache[key] = values
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return torch.stack(q_values)[torch.as_tensor(inverse, device=q_values[0].device)]
+
+
+class GroupedQNetworks:
+    """
+    Runs several Q-networks on one state each
+    Dense/ConvQNetworks of the same architecture are stacked and evaluated at once, the other
+    networks one after the other. Stacked parameters are copies, regroup the networks after
+    changing them.
+    """
+
+    def __init__(self, qnetworks: Sequence[nn.Module]):
+        self.num_networks = len(qnetworks)
+        groups = defaultdict(list)
+        for index, qnetwork in enumerate(qnetworks):
+            stackable = isinstance(qnetwork, (DenseQNetwork, ConvQNetwork))
+            groups[(type(qnetwork), repr(qnetwork)) if stackable else index].append(index)
+
+        self.groups = []  # (indices, forward of their states)
+        for indices in groups.values():
+            forward = qnetworks[indices[0]] if len(indices) == 1 else self._stack([qnetworks[i] for i in indices])
+            self.groups.append((torch.as_tensor(indices, device=device), forward))
+
+    @staticmethod
+    def _stack(qnetworks):
+        params, buffers = torch.func.stack_module_state(qnetworks)
+        layers = GroupedQNetworks._stacked_layers(qnetworks[0], params, len(qnetworks))
+        if layers is not None:
+            def stacked_q_values(states):
+                if isinstance(qnetworks[0], ConvQNetwork):
+                    hidden = states.permute(0, 3, 1, 2).reshape(1, -1, *states.shape[1:3])
+                else:
+                    hidden = states.reshape(len(states), 1, -1)
+                for layer in layers:
+                    hidden = layer(hidden)
+                return hidden.reshape(len(states), -1)
+            return stacked_q_values
+
+        # Other layers go through vmap, which has a large overhead on small layers
+        base = copy.deepcopy(qnetworks[0]).to('meta')
+
+        def q_values(params, buffers, state):
+            return torch.func.functional_call(base, (params, buffers), (state.unsqueeze(0),)).squeeze(0)
+
+        batched_q_values = torch.vmap(q_values)
+        return lambda states: batched_q_values(params, buffers, states)
+
+    @staticmethod
+    def _stacked_layers(qnetwork, params, num_networks):
+        """
+        Layers of stacked networks: a convolution with a group per network for conv layers
+        and a batched matrix product for dense layers, None for other layers
+        """
+        layers = []
+        for name, module in qnetwork.network.named_children():
+            if isinstance(module, nn.Conv2d) and module.groups == 1 and module.padding_mode == 'zeros':
+                weight, bias = params[f'network.{name}.weight'], params[f'network.{name}.bias']
+                layers.append(functools.partial(
+                    F.conv2d, weight=weight.flatten(0, 1), bias=bias.flatten(), stride=module.stride,
+                    padding=module.padding, dilation=module.dilation, groups=num_networks))
+            elif isinstance(module, nn.Linear):
+                weight, bias = params[f'network.{name}.weight'], params[f'network.{name}.bias']
+                layers.append(functools.partial(torch.baddbmm, bias.unsqueeze(1), batch2=weight.transpose(1, 2)))
+            elif isinstance(module, nn.Flatten):
+                layers.append(lambda hidden: hidden.reshape(num_networks, 1, -1))
+            elif isinstance(module, nn.ReLU):
+                layers.append(module)
+            else:
+                return None
+        return layers
+
+    def __call__(self, states):
+        """Q-values (num_networks, n_actions) of the states, one per network"""
+        states = states_to_tensor(states)
+        q_values = None
+        for indices, forward in self.groups:
+            group_q_values = forward(states[indices])
+            if q_values is None:
+                q_values = group_q_values.new_empty((self.num_networks, *group_q_values.shape[1:]))
+            q_values[indices] = group_q_values
+        return q_values
+
+
+def load_qnetwork(path, compile: Optional[str] = None):
+    """
+    Loads a Q-network from a safetensors checkpoint or a TorchScript artifact saved by CompiledQNetwork
+    With compile set to 'script' or 'compile', checkpoints are compiled for inference
+    """
+    if path.endswith('.safetensors'):
+        qnetwork = BaseDQNFactory.from_checkpoint(path).create_qnetwork()[0]
+        return qnetwork if compile is None else CompiledQNetwork.from_qnetwork(qnetwork, compile)
+    return CompiledQNetwork.load(path, compile or 'script')
+
+
+def td_loss(q_values: Tensor, action: Tensor, reward: Tensor, next_q_values: Tensor, done: Tensor, gamma: float):
+    """Mean squared TD error of the Q-values of the actions taken"""
+    q_value = q_values.gather(1, action.unsqueeze(1)).squeeze(1)
+    td_target = reward + gamma * next_q_values.max(1)[0] * (1 - done)
+    return (q_value - td_target.detach()).pow(2).mean()
+
+
 class BaseDQNFactory():
     """
     A template class to generate custom Q-networks and their optimizers
@@ -281,7 +537,9 @@ class DQNAgent():
     """
 
     def __init__(self, env, dqn_factory, gamma, epsilon_start, epsilon_decay, epsilon_end, memory_size, batch_size,
-                 target_update_interval, logger: Optional[Logger] = None):
+                 target_update_interval, logger: Optional[Logger] = None, prefetch_batches: int = 0,
+                 n_drones: int = 1, train_every: int = 1, gradient_steps: int = 1, fuse_gradient_steps: bool = False,
+                 compile: Optional[str] = None, cache_size: int = 0):
         # Save parameters
         self.env = env
         self.dqn_factory = dqn_factory  # Factory to create q-networks + optimizers
@@ -294,13 +552,22 @@ class DQNAgent():
         self.target_update_interval = target_update_interval  # Update rate
         self.is_greedy = False  # Does the agent behave greedily?
         self.logger = logger or NoLogger()
+        self.prefetch_batches = prefetch_batches  # Batches prepared by a background thread, 0 to disable
+        self.n_drones = n_drones  # Drones sharing this agent through learn_batch, one replay stream each
+        self.train_every = train_every  # Environment steps between training rounds
+        self.gradient_steps = gradient_steps  # Minibatches of batch_size per training round
+        self.fuse_gradient_steps = fuse_gradient_steps  # Merge the minibatches of a round in one update
+        self.compile = compile  # Run networks, loss and optimizer step with 'script' or 'compile', None for eager
+        self.cache_size = cache_size  # Observations whose Q-values are memoized for greedy actions, 0 to disable
+        if train_every < 1 or gradient_steps < 1:
+            raise ValueError(f"train_every and gradient_steps must be positive, got {train_every} and {gradient_steps}")
+        self.prefetcher = None
 
         self.reset()
 
     def reset(self):
         # Create networks with episode counter to know when to update them
-        self.qnetwork, self.optimizer = self.dqn_factory.create_qnetwork()
-        self.target_qnetwork, _ = self.dqn_factory.create_qnetwork()
+        self.create_qnetworks()
         self.num_episode = 0
         self.episode_reward = 0
         self.total_steps = 0
@@ -310,7 +577,17 @@ class DQNAgent():
         self.epsilons = []
 
         # Create new replay memory
-        self.memory = deque(maxlen=self.memory_size)
+        self.close()
+        self.memory = ReplayMemory(self.memory_size, self.n_drones)
+        self.drone_streams = {}
+        self.stream_rewards = np.zeros(self.n_drones)
+
+    def close(self):
+        """Stops the batch prefetching thread, a later training step starts a new one"""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     def save(self, path):
       print("--- DQNAgent.save method IS being called ---") # Temporary debug print
 
@@ -328,7 +605,7 @@ class DQNAgent():
         
         state_dict = self.qnetwork.state_dict()
         metadata = {
-            "network_type": "dense" if isinstance(self.qnetwork, DenseQNetwork) else "conv",
+            "network_type": "dense" if isinstance(self.dqn_factory, DenseQNetworkFactory) else "conv",
             "dense_layers": str(self.dqn_factory.dense_layers),
             "obs_shape": str(self.dqn_factory.obs_shape),
             "action_shape": str(self.dqn_factory.action_shape),
@@ -344,8 +621,24 @@ class DQNAgent():
 
     def load(self, path):
         self.dqn_factory = BaseDQNFactory.from_checkpoint(path)
+        self.create_qnetworks()
+
+    def create_qnetworks(self):
         self.qnetwork, self.optimizer = self.dqn_factory.create_qnetwork()
         self.target_qnetwork, _ = self.dqn_factory.create_qnetwork()
+        self.td_loss, self.optimizer_step = td_loss, self.optimizer.step
+        if self.compile is not None:
+            self.qnetwork = CompiledQNetwork.from_qnetwork(self.qnetwork, self.compile)
+            self.target_qnetwork = CompiledQNetwork.from_qnetwork(self.target_qnetwork, self.compile)
+            if self.compile == 'script':
+                self.td_loss = torch.jit.script(td_loss)
+            else:
+                self.td_loss, self.optimizer_step = torch.compile(td_loss), torch.compile(self.optimizer.step)
+        self.cached_qnetwork = CachedQNetwork(self.qnetwork, self.cache_size) if self.cache_size > 0 else None
+
+    def greedy_qnetwork(self):
+        """Q-network for greedy actions, memoized for greedy agents with a cache"""
+        return self.cached_qnetwork if self.is_greedy and self.cached_qnetwork is not None else self.qnetwork
 
     def act(self, state):
         # Exploration rate
@@ -354,12 +647,27 @@ class DQNAgent():
         if np.random.rand() < epsilon:
             return self.env.action_space.sample()
         else:
-            q_values = self.qnetwork([state])[0]
+            q_values = self.greedy_qnetwork()([state])[0]
             return q_values.argmax().item()  # Greedy action
 
+    def act_batch(self, states, agent_ids):
+        """Epsilon-greedy actions of several drones controlled by this agent, with one forward pass"""
+        epsilon = 0.0 if self.is_greedy else self.epsilon
+
+        action_space = self.env.action_space
+        explore = np.random.rand(len(agent_ids)) < epsilon
+        actions = action_space.start + action_space.np_random.integers(action_space.n, size=len(agent_ids))
+        greedy = np.flatnonzero(~explore)
+        if len(greedy) > 0:
+            states = states if len(greedy) == len(agent_ids) else np.asarray(states)[greedy]
+            with torch.no_grad():
+                q_values = self.greedy_qnetwork()(states)
+            actions[greedy] = q_values.argmax(dim=1).cpu().numpy()
+        return dict(zip(agent_ids, actions.tolist()))
+
     def learn(self, state, action, reward, next_state, done):
         # Memorize experience
-        self.memory.append((state, action, reward, next_state, done))
+        self.memory.append(state, action, reward, next_state, done)
         self.episode_reward += reward
         self.total_steps += 1
 
@@ -378,47 +686,104 @@ class DQNAgent():
 
             self.episode_reward = 0
 
+        self.train_step()
+
+    def learn_batch(self, states, actions, rewards, next_states, dones, agent_ids):
+        """
+        Learns from one environment step of several drones controlled by this agent
+        Their transitions go to the pooled replay memory and count as a single step
+        """
+        streams = self.streams(agent_ids)
+        rewards = np.asarray(rewards, dtype=np.float64)
+        dones = np.asarray(dones, dtype=bool)
+        self.memory.append_batch(states, actions, rewards, next_states, dones, streams)
+        self.stream_rewards[streams] += rewards
+        self.total_steps += 1
+
+        # End of episodes
+        finished = streams[dones]
+        if len(finished) > 0:
+            self.num_episode += len(finished)  # Episode counter
+            self.logger.log_dict(self.total_steps, {
+                'episode_reward': self.stream_rewards[finished].mean(),
+                'memory_size': len(self.memory),
+            })
+            self.epsilons.append(self.epsilon)  # Log epsilon value
+
+            # Epsilon decay, once per episode
+            self.epsilon = max(
+                self.epsilon * self.epsilon_decay ** len(finished), self.epsilon_end)
+
+            self.stream_rewards[finished] = 0
+
+        self.train_step()
+
+    def streams(self, agent_ids):
+        """Replay streams of the drones, assigned in order of appearance"""
+        streams = np.zeros(len(agent_ids), dtype=np.int64)
+        for i, agent_id in enumerate(agent_ids):
+            stream = self.drone_streams.get(agent_id)
+            if stream is None:
+                if len(self.drone_streams) >= self.n_drones:
+                    raise ValueError(f"Agent already controls its {self.n_drones} drones, cannot add {agent_id}")
+                stream = self.drone_streams[agent_id] = len(self.drone_streams)
+            streams[i] = stream
+        return streams
+
+    def train_step(self):
         # Periodically update target network with current one
         if self.total_steps % self.target_update_interval == 0:
             self.target_qnetwork.load_state_dict(self.qnetwork.state_dict())
 
-        # Train when we have enough experiences in the replay memory
-        if len(self.memory) > self.batch_size:
-            # Sample batch of experience
-            # batch = random.sample(self.memory, self.batch_size)
-            batch_indices = np.random.choice(
-                len(self.memory), self.batch_size, replace=False)
-            batch = [self.memory[idx] for idx in batch_indices]
-            state, action, reward, next_state, done = zip(*batch)
-
-            action = LongTensor(action).to(device)
-            reward = Tensor(reward).to(device)
-            done = Tensor(done).to(device)
-
-            # Q-value for current state given current action
-            q_values = self.qnetwork(state)
-            q_value = q_values.gather(1, action.unsqueeze(1)).squeeze(1)
-
-            # Compute the TD target
-            next_q_values = self.target_qnetwork(next_state)
-            next_q_value = next_q_values.max(1)[0]
-
-            td_target = reward + self.gamma * next_q_value * (1 - done)
-
-            # Optimize quadratic loss
-            loss = (q_value - td_target.detach()).pow(2).mean()
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+        if self.total_steps % self.train_every != 0:
+            return
 
-            self.logger.log_dict(self.total_steps, {
-                'dqn/loss': loss.item(),
-                'dqn/reward': reward.mean().item(),
-            })
+        # Train when we have enough experiences in the replay memory
+        if len(self.memory) > self.update_batch_size:
+            for _ in range(1 if self.fuse_gradient_steps else self.gradient_steps):
+                self.gradient_step()
         else:
             # print(f"Not learning yet! {len(self.memory)}/{self.batch_size} experiences")
             pass
 
+    @property
+    def update_batch_size(self):
+        """Samples per gradient step, all minibatches of a round when they are fused"""
+        return self.batch_size * (self.gradient_steps if self.fuse_gradient_steps else 1)
+
+    def gradient_step(self):
+        # Sample batch of experience
+        state, action, reward, next_state, done = self.sample_batch()
+
+        # Q-values for current and next states
+        q_values = self.qnetwork(state)
+        next_q_values = self.target_qnetwork(next_state)
+
+        # Optimize quadratic loss to the TD target
+        loss = self.td_loss(q_values, action, reward, next_q_values, done, self.gamma)
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer_step()
+
+        self.logger.log_dict(self.total_steps, {
+            'dqn/loss': loss.detach(),
+            'dqn/reward': reward.mean(),
+        })
+
+    def sample_batch(self):
+        """Batch of states, actions, rewards, next_states and dones, actions/rewards/dones as tensors on device"""
+        if self.prefetch_batches > 0:
+            if self.prefetcher is None:
+                self.prefetcher = BatchPrefetcher(self.memory, self.update_batch_size, device, self.prefetch_batches)
+            state, action, reward, next_state, done = self.prefetcher.get()
+            return state, action, reward, next_state, done.float()
+
+        state, action, reward, next_state, done = self.memory.sample(self.update_batch_size)
+        action = torch.as_tensor(action, device=device)
+        reward = torch.as_tensor(reward, device=device)
+        done = torch.as_tensor(done, dtype=torch.float32, device=device)
+        return state, action, reward, next_state, done
+
     def __repr__(self) -> str:
         return f"DQNAgent(dqn_factory={self.dqn_factory})"
 
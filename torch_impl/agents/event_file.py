@@ -0,0 +1,148 @@
+"""
+Writer of TensorBoard event files without TensorFlow
+Events are Event protocol buffers (tensorflow/core/util/event.proto) framed as TFRecords,
+the few messages needed for scalars and histograms are encoded by hand.
+"""
+import itertools
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+def _crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+_file_counter = itertools.count()
+
+
+def crc32c(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data: bytes) -> int:
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord(data: bytes) -> bytes:
+    """TFRecord framing: length, masked CRC of the length, data, masked CRC of the data"""
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', masked_crc32c(length)) + data + struct.pack('<I', masked_crc32c(data))
+
+
+def _varint(value: int) -> bytes:
+    value &= 0xFFFFFFFFFFFFFFFF  # Negative int64 take 10 bytes
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _int64_field(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(value)
+
+
+def _double_field(field: int, value: float) -> bytes:
+    return _varint(field << 3 | 1) + struct.pack('<d', value)
+
+
+def _float_field(field: int, value: float) -> bytes:
+    return _varint(field << 3 | 5) + struct.pack('<f', value)
+
+
+def _bytes_field(field: int, value: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed_doubles_field(field: int, values) -> bytes:
+    return _bytes_field(field, np.asarray(values, dtype='<f8').tobytes())
+
+
+def event(step: int, summary_values=(), file_version: str = None, wall_time: float = None) -> bytes:
+    """Event message with a Summary of the encoded Summary.Value messages"""
+    message = _double_field(1, time.time() if wall_time is None else wall_time) + _int64_field(2, step)
+    if file_version is not None:
+        message += _bytes_field(3, file_version.encode())
+    if summary_values:
+        message += _bytes_field(5, b''.join(_bytes_field(1, value) for value in summary_values))
+    return message
+
+
+def scalar_value(tag: str, value: float) -> bytes:
+    return _bytes_field(1, tag.encode()) + _float_field(2, value)
+
+
+def histogram_value(tag: str, values, bins=1000) -> bytes:
+    """Summary.Value of a HistogramProto computed with NumPy"""
+    values = np.asarray(values, dtype=np.float64)
+    counts, bin_edges = np.histogram(values, bins=bins)
+    histogram = b''.join([
+        _double_field(1, values.min()),
+        _double_field(2, values.max()),
+        _double_field(3, values.size),
+        _double_field(4, values.sum()),
+        _double_field(5, np.square(values).sum()),
+        _packed_doubles_field(6, bin_edges[1:]),
+        _packed_doubles_field(7, counts),
+    ])
+    return _bytes_field(1, tag.encode()) + _bytes_field(5, histogram)
+
+
+class EventFileWriter:
+    """
+    Appends events to a new event file of log_dir from a background thread
+    The records are framed and the file is flushed by the thread once it has written every queued event
+    """
+
+    def __init__(self, log_dir: str) -> None:
+        os.makedirs(log_dir, exist_ok=True)
+        # Unique within the process, like TensorBoard, and 'xb' fails rather than truncating another writer's file
+        name = f"events.out.tfevents.{int(time.time())}.{socket.gethostname()}.{os.getpid()}.{next(_file_counter)}"
+        self.path = os.path.join(log_dir, name)
+        self.file = open(self.path, 'xb')
+        self.file.write(tfrecord(event(0, file_version='brain.Event:2')))
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self) -> None:
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                self.file.write(tfrecord(record))
+                if self.queue.empty():
+                    self.file.flush()
+            finally:
+                self.queue.task_done()
+
+    def add_event(self, event_bytes: bytes) -> None:
+        self.queue.put(event_bytes)  # Framed by the thread, the CRCs are computed in Python
+
+    def flush(self) -> None:
+        self.queue.join()
+        self.file.flush()
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
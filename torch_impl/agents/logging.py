@@ -1,10 +1,14 @@
 import datetime
 import os
 import pathlib
+import queue
+import threading
 from abc import abstractmethod, ABC
 from typing import Any
 
-import numpy as np
+import torch
+
+from .event_file import EventFileWriter, event, histogram_value, scalar_value
 
 
 class Logger(ABC):
@@ -14,43 +18,104 @@ class Logger(ABC):
 
     @abstractmethod
     def log_dict(self, global_step: int, values: dict) -> None:
+        """Logs values given as numbers or scalar tensors"""
         pass
 
 
 class TensorBoardLogger(Logger):
+    """
+    Logger writing TensorBoard event files to path/name without TensorFlow, see event_file
+    """
+
     def __init__(self, path: str, name: str) -> None:
         super().__init__()
-        import tensorflow as tf
         pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-        self.summary_writer = tf.summary.FileWriter(os.path.join(path, name))
+        self.summary_writer = EventFileWriter(os.path.join(path, name))
 
     def log_histogram(self, global_step: int, name: str, values: Any, bins=1000) -> None:
-        import tensorflow as tf
-        counts, bin_edges = np.histogram(values, bins=bins)
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values ** 2))
-        bin_edges = bin_edges[1:]
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
-        summary = tf.Summary(value=[tf.Summary.Value(tag=name, histo=hist)])
-        self.log_tensoboard_summary(global_step, summary)
+        self.summary_writer.add_event(event(global_step, [histogram_value(name, values, bins)]))
 
     def log_dict(self, global_step: int, values: dict) -> None:
-        import tensorflow as tf
-        summary = tf.Summary(value=[tf.Summary.Value(tag=name, simple_value=value) for name, value in values.items()])
-        self.log_tensoboard_summary(global_step, summary)
+        self.summary_writer.add_event(event(global_step, [
+            scalar_value(name, float(value)) for name, value in values.items()]))
 
-    def log_tensoboard_summary(self, global_step: int, summary) -> None:
-        self.summary_writer.add_summary(summary, global_step)
+    def flush(self) -> None:
+        self.summary_writer.flush()
+
+    def close(self) -> None:
+        self.summary_writer.close()
 
 
 class NoLogger(Logger):
 
     def log_dict(self, global_step: int, values: dict) -> None:
         pass
+
+
+class AggregatingLogger(Logger):
+    """
+    Logger averaging values over intervals of global steps before passing them to another logger
+    Tensor values are summed on their device without synchronizing, reduced to floats with a
+    single transfer per interval, and the other logger writes them from a background thread
+    """
+
+    def __init__(self, logger: Logger, interval: int = 100) -> None:
+        super().__init__()
+        if interval < 1:
+            raise ValueError(f"Interval must be positive, got {interval}")
+        self.logger = logger
+        self.interval = interval
+        self.sums = {}
+        self.counts = {}
+        self.interval_start = None  # First global step of the current interval
+        self.last_step = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.logger.log_dict(*item)
+            finally:
+                self.queue.task_done()
+
+    def log_dict(self, global_step: int, values: dict) -> None:
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+            self.counts[name] = self.counts.get(name, 0) + 1
+        self.last_step = global_step
+
+        if self.interval_start is None:
+            self.interval_start = global_step
+        elif global_step - self.interval_start >= self.interval:
+            self.reduce()
+
+    def reduce(self) -> None:
+        """Hands the means of the current interval to the writer thread"""
+        if not self.sums:
+            return
+        names = list(self.sums.keys())
+        tensors = [name for name in names if isinstance(self.sums[name], torch.Tensor)]
+        sums = {name: float(self.sums[name]) for name in names if name not in tensors}
+        if tensors:
+            stacked = torch.stack([self.sums[name].float().reshape(()) for name in tensors])
+            sums.update(zip(tensors, stacked.tolist()))  # Single device sync
+        self.queue.put((self.last_step, {name: sums[name] / self.counts[name] for name in names}))
+        self.sums, self.counts = {}, {}
+        self.interval_start = None
+
+    def flush(self) -> None:
+        """Writes the current interval and waits for the writer thread"""
+        self.reduce()
+        self.queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
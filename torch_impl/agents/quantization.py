@@ -0,0 +1,39 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfigMapping, default_dynamic_qconfig, get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from .dqn import ConvQNetwork, DenseQNetwork, QNetwork, device, states_to_tensor
+
+
+def quantize_qnetwork(qnetwork: QNetwork, reference_states) -> QNetwork:
+    """
+    Int8 copy of a Dense/ConvQNetwork for CPU inference
+    Dense layers are quantized dynamically, conv layers statically with scales calibrated on reference_states
+    """
+    if device != 'cpu':
+        raise ValueError(f"Quantized Q-networks run on cpu, not {device}")
+    if not isinstance(qnetwork, (DenseQNetwork, ConvQNetwork)):
+        raise ValueError(f"Cannot quantize {type(qnetwork).__name__}")
+
+    quantized = copy.deepcopy(qnetwork).eval()
+    if isinstance(qnetwork, ConvQNetwork):
+        inputs = states_to_tensor(reference_states).permute(0, 3, 1, 2)
+        qconfig_mapping = QConfigMapping() \
+            .set_module_name_regex('conv2d_.*', get_default_qconfig(torch.backends.quantized.engine)) \
+            .set_module_name_regex('dense_.*', default_dynamic_qconfig)
+        prepared = prepare_fx(quantized.network, qconfig_mapping, (inputs[:1],))
+        with torch.no_grad():
+            prepared(inputs)  # Calibrate
+        quantized.network = convert_fx(prepared)
+    else:
+        quantized.network = quantize_dynamic(quantized.network, {nn.Linear}, dtype=torch.qint8)
+    return quantized
+
+
+def argmax_agreement(qnetwork: QNetwork, other: QNetwork, states) -> float:
+    """Fraction of states where both Q-networks take the same greedy action"""
+    with torch.no_grad():
+        return (qnetwork(states).argmax(1) == other(states).argmax(1)).float().mean().item()
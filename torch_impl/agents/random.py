@@ -8,6 +8,11 @@ class RandomAgent():
     def act(self, state):
         return self.env.action_space.sample()
 
+    def act_batch(self, states, agent_ids):
+        action_space = self.env.action_space
+        actions = action_space.start + action_space.np_random.integers(action_space.n, size=len(agent_ids))
+        return dict(zip(agent_ids, actions.tolist()))
+
     def reset(self):
         pass
 
@@ -12,6 +12,7 @@ from env.wrappers import WindowedGridView
 
 from agents.dqn import DQNAgent, DenseQNetworkFactory
 from agents.random import RandomAgent
+from helpers.rl_helpers import act_all
 
 
 @dataclass
@@ -30,6 +31,10 @@ class Config:
 # CONFIG #
 train = True
 n_steps = 100
+prefetch_batches = 0  # batches prepared in the background for the DQN learner, e.g. 2 (0 disables it)
+train_every = 1  # env steps between DQN training rounds
+gradient_steps = 1  # minibatches per training round
+fuse_gradient_steps = False  # one update on the merged minibatches of a round
 drone_counts = [32, 128, 512, 2048]
 
 configs = [
@@ -53,6 +58,11 @@ impls = [
         env=WindowedGridView(DeliveryDrones(), radius=3),
         desc="dict-based version"
     ),
+    Impl(
+        name="v4",
+        env=WindowedGridView(DeliveryDrones(engine='array'), radius=3),
+        desc="array-based version"
+    ),
 ]
 # /CONFIG #
 
@@ -84,14 +94,15 @@ def benchmark_implementation(imp, config, n_drones, n_steps, train):
 
     rewards_log = {}
     if train:
-        agents = {drone.index: RandomAgent(imp.env) for drone in imp.env.drones}
+        random_agent = RandomAgent(imp.env)
+        agents = {drone.index: random_agent for drone in imp.env.drones_list}
         rewards_log = {key: [] for key in agents.keys()}
         agents[0] = DQNAgent(
             env=imp.env,
             dqn_factory=DenseQNetworkFactory(
                 imp.env.observation_space.shape,
                 (imp.env.action_space.n,),
-                hidden_layers=(16) * 2
+                hidden_layers=(16,) * 2
             ),
             gamma=0.95,
             epsilon_start=1.0,
@@ -99,7 +110,11 @@ def benchmark_implementation(imp, config, n_drones, n_steps, train):
             epsilon_end=0.01,
             memory_size=10_000_000,
             batch_size=32,
-            target_update_interval=4
+            target_update_interval=4,
+            prefetch_batches=prefetch_batches,
+            train_every=train_every,
+            gradient_steps=gradient_steps,
+            fuse_gradient_steps=fuse_gradient_steps
         )
 
     total_time_act = 0
@@ -111,9 +126,9 @@ def benchmark_implementation(imp, config, n_drones, n_steps, train):
     for i in pbar:
         time_act_start = time.perf_counter()
         if train:
-            actions = {key: agent.act(states[key]) for key, agent in agents.items()}
+            actions = act_all(agents, states)
         else:
-            actions = {drone.index: imp.env.action_space.sample() for drone in imp.env.drones}
+            actions = {drone.index: imp.env.action_space.sample() for drone in imp.env.drones_list}
         total_time_act += time.perf_counter() - time_act_start
 
         time_env_start = time.perf_counter()
@@ -131,6 +146,8 @@ def benchmark_implementation(imp, config, n_drones, n_steps, train):
         total_time_learn += time.perf_counter() - time_learn_start
 
         # pbar.set_description(f"{statistics.mean(rewards_log[0][-500:]):.3f}")
+    if train:
+        agents[0].close()
 
     total_time = time.perf_counter() - start_time
     mean_time = (total_time / n_steps) * 1000
@@ -153,6 +170,7 @@ def benchmark_implementation(imp, config, n_drones, n_steps, train):
     results.append([
         imp.name, config.name, n_drones, f"{imp.env.side_size}x{imp.env.side_size}", f"{mean_time:.2f} spKs",
         f"{sps:.1f} sps",
+        f"{gradient_steps}/{train_every}{' fused' if fuse_gradient_steps else ''}" if train else "-",
         # f"{percent_diff:.2f}",
         f"{mean_time_act:.3f} ms", f"{mean_time_env:.3f} ms", f"{mean_time_lean:.3f} ms",
         reward_trained, reward_untrained
@@ -170,7 +188,7 @@ if __name__ == '__main__':
     print(f"Training? {train}")
     print(
         tabulate(results, headers=[
-            'Implementation', 'Config', 'Drones', "Size", 'Speed', 'Speed',
+            'Implementation', 'Config', 'Drones', "Size", 'Speed', 'Speed', 'Grad steps/env steps',
             # 'Speedup from V1',
             'Time act', 'Time env', 'Time learn',
             'Score trained', 'Score untrained'
@@ -181,3 +199,4 @@ if __name__ == '__main__':
         print(f"{imp.name}: {imp.desc}")
     print("=" * 15)
     print(f"{n_steps:,} steps per run.")
+    print(f"{prefetch_batches} prefetched batches.")
@@ -0,0 +1,359 @@
+import random
+from dataclasses import dataclass
+
+import numpy as np
+
+from common.constants import Object
+from .env import DeliveryDrones, Drone, EnvSnapshot, _frozen
+from .free_cells import FreeCellIndex
+
+
+DIRECTIONS = np.array(DeliveryDrones.ACTION_TO_DIRECTION, dtype=np.int32)
+EMPTY = -1  # value of an air cell without a drone
+
+
+@dataclass
+class MoveOutcome:
+    positions: np.ndarray  # (B, n, 2) cells the drones moved to, clipped to the grid
+    rewards: np.ndarray  # (B, n)
+    crashed: np.ndarray  # (B, n)
+    respawn_key: np.ndarray  # (B, n) crashed drones respawn by increasing key
+    consumed: np.ndarray  # flat ids (over the B grids) of picked up packets and used dropzones
+    nb_packets: np.ndarray  # (B,) packets to respawn
+    nb_dropzones: np.ndarray  # (B,) dropzones to respawn
+
+
+def resolve_moves(ground, positions, charge, packet, rank, actions, env_params):
+    """
+    Vectorized move/collision/charge/pickup/delivery rules of DeliveryDrones
+
+    Works on a batch of B worlds: ground is (B, side, side), positions (B, n, 2),
+    charge/packet/rank/actions are (B, n). `rank` gives the position of each drone
+    in the iteration order of the dict engine, which decides who wins a contested cell.
+    ground, charge and packet are updated in place.
+
+    Crashed drones must be respawned by increasing `respawn_key` to reproduce the
+    dict engine.
+    """
+    B, n = actions.shape
+    side = ground.shape[-1]
+    new_positions = positions + DIRECTIONS[actions]
+    in_bounds = ((new_positions >= 0) & (new_positions < side)).all(axis=-1)
+    y = np.clip(new_positions[..., 0], 0, side - 1)
+    x = np.clip(new_positions[..., 1], 0, side - 1)
+    cells = (np.arange(B)[:, None] * side + y) * side + x
+
+    # Drones moving to the same cell: the first one in iteration order takes it,
+    # the others crash right away and the winner crashes once it has been processed
+    flat_rank = rank.ravel()
+    flat_cells = cells.ravel()
+    candidates = np.flatnonzero(in_bounds.ravel())
+    candidates = candidates[np.lexsort((flat_rank[candidates], flat_cells[candidates]))]
+    sorted_cells = flat_cells[candidates]
+    group_start = np.ones(len(candidates), dtype=bool)
+    group_start[1:] = sorted_cells[1:] != sorted_cells[:-1]
+    starts = np.flatnonzero(group_start)
+    group_size = np.diff(np.append(starts, len(candidates)))
+    winners = candidates[starts]
+    contested = group_size > 1
+
+    winner = np.zeros(B * n, dtype=bool)
+    winner[winners] = True
+    collided = np.zeros(B * n, dtype=bool)
+    collided[winners[contested]] = True
+    first_loser_rank = np.zeros(B * n, dtype=np.int64)
+    first_loser_rank[winners[contested]] = flat_rank[candidates[starts[contested] + 1]]
+    winner = winner.reshape(B, n)
+    collided = collided.reshape(B, n)
+    first_loser_rank = first_loser_rank.reshape(B, n)
+    moved_out = ~winner  # out of bounds or lost a contested cell
+
+    rewards = np.zeros((B, n), dtype=np.float64)
+    flat_ground = ground.reshape(-1)
+    under = np.where(winner, flat_ground[cells], 0)
+
+    # charging/discharging
+    at_station = under == Object.STATION
+    charge[at_station] = np.minimum(100, charge[at_station] + env_params['charge'])
+    discharging = winner & ~at_station
+    charge[discharging] -= env_params['discharge']
+    dead_battery = discharging & (charge <= 0)
+    rewards[at_station] = env_params['charge_reward']
+
+    # pickup/delivery
+    picked = (under == Object.PACKET) & ~packet
+    delivered = (under == Object.DROPZONE) & packet
+    rewards[picked] = env_params['pickup_reward']
+    rewards[delivered] = env_params['delivery_reward']
+    packet[picked] = True
+    packet[delivered] = False
+    consumed = cells[picked | delivered]
+    flat_ground[consumed] = 0
+
+    # skyscrapers
+    in_skyscraper = under == Object.SKYSCRAPER
+
+    # Crashes in the order the dict engine discovers them: drones that could not move,
+    # then winners of contested cells (by first loser), then dead batteries and skyscrapers
+    late_crash = winner & (collided | dead_battery | in_skyscraper)
+    crashed = moved_out | late_crash
+    respawn_key = np.where(moved_out, rank, np.where(collided, n + first_loser_rank, 2 * n + rank))
+
+    nb_packets = (crashed & packet).sum(axis=1) + delivered.sum(axis=1)
+    nb_dropzones = delivered.sum(axis=1)
+    rewards[crashed] = env_params['crash_reward']
+    charge[crashed] = 100
+    packet[crashed] = False
+
+    return MoveOutcome(
+        positions=np.stack([y, x], axis=-1),
+        rewards=rewards,
+        crashed=crashed,
+        respawn_key=respawn_key,
+        consumed=consumed,
+        nb_packets=nb_packets,
+        nb_dropzones=nb_dropzones,
+    )
+
+
+class ArrayDeliveryDrones(DeliveryDrones):
+    """
+    NumPy engine for DeliveryDrones
+
+    The world is stored as occupancy grids (int8 ground with `Object` values and an int32
+    air layer holding drone indices, -1 when empty) plus struct-of-arrays drone state.
+    All moves, collisions, charging, pickups and deliveries are array operations; only
+    respawns loop, over the crashed drones and consumed objects of the step.
+
+    Rewards, respawns and random number consumption match the dict engine, so both
+    engines produce the same episodes for the same seeds. The dict views (`drones`,
+    `packets`, ...) are built on demand and are read-only snapshots.
+
+    Unwrapped observations differ from the dict engine's: reset and step return the
+    arrays of get_state rather than the `drones`, `stations`, `dropzones`, `packets` and
+    `skyscrapers` dicts, which would have to be built every step. The wrappers give the same
+    observations with both engines, code reading unwrapped observations can use the dict views.
+    """
+
+    def reset(self, seed=None):
+        super(DeliveryDrones, self).reset(seed=seed)  # seeds self.np_random
+        self._configure()
+        if self.env_params['reset_sampler'] == 'vectorized':
+            drones, packets, dropzones, stations, skyscrapers = self._sample_layout()
+            # Drone indices in the iteration order of the dict engine
+            self.order = np.arange(self.n_drones)
+        else:
+            layout = self._spawn_layout()
+            drones = np.zeros(self.n_drones, dtype=np.int64)
+            drones[[drone.index for drone in layout[0].values()]] = self._cells(layout[0])
+            packets, dropzones, stations, skyscrapers = [self._cells(objects) for objects in layout[1:]]
+            self.order = np.array([drone.index for drone in layout[0].values()], dtype=np.int64)
+
+        self.ground = np.zeros(self.shape, dtype=np.int8)
+        for obj, cells in [
+                (Object.SKYSCRAPER, skyscrapers), (Object.PACKET, packets),
+                (Object.DROPZONE, dropzones), (Object.STATION, stations)]:
+            self.ground.flat[cells] = obj
+
+        self.positions = np.stack(np.divmod(drones, self.side_size), axis=-1).astype(np.int32)
+        self.charge = np.full(self.n_drones, 100, dtype=np.int32)
+        self.packet = np.zeros(self.n_drones, dtype=bool)
+        self.air = np.full(self.shape, EMPTY, dtype=np.int32)
+        self.air[self.positions[:, 0], self.positions[:, 1]] = np.arange(self.n_drones)
+        self._count_blocked_cells()
+        self._build_free_cells()
+
+        # Check if some packets are immediately picked
+        self._pick_packets_after_respawn()
+
+        # (k, 2) positions of the cells whose content changed during the last step
+        self.changed_cells = None
+        self.world_version += 1
+        return self.get_state(), None
+
+    def _count_blocked_cells(self):
+        # Kept up to date by steps, so that respawns do not scan the grids
+        self.n_skyscrapers = np.count_nonzero(self.ground == Object.SKYSCRAPER)
+        self.n_ground_objects = np.count_nonzero(self.ground)
+        self.n_flying = self.n_drones
+
+    def _build_free_cells(self):
+        sampler = self.env_params['respawn_sampler']
+        if sampler == 'index':
+            self.ground_cells = FreeCellIndex(self.side_size, np.flatnonzero(self.ground))
+            self.drone_cells = FreeCellIndex(
+                self.side_size, np.flatnonzero((self.air != EMPTY) | (self.ground == Object.SKYSCRAPER)))
+        elif sampler == 'rejection':
+            self.ground_cells = self.drone_cells = None
+        else:
+            raise ValueError(f"Unknown respawn sampler: {sampler}")
+
+    def snapshot(self):
+        return EnvSnapshot(
+            positions=_frozen(self.positions.copy()),
+            charge=_frozen(self.charge.copy()),
+            packet=_frozen(self.packet.copy()),
+            order=_frozen(self.order.copy()),
+            objects=tuple(
+                _frozen(np.flatnonzero(self.ground == obj))
+                for obj in [Object.PACKET, Object.DROPZONE, Object.STATION, Object.SKYSCRAPER]),
+            **self._snapshot_rngs(),
+        )
+
+    def restore(self, snapshot):
+        self.positions = snapshot.positions.copy()
+        self.charge = snapshot.charge.copy()
+        self.packet = snapshot.packet.copy()
+        self.order = snapshot.order.copy()
+        self.ground = np.zeros(self.shape, dtype=np.int8)
+        for obj, cells in zip([Object.PACKET, Object.DROPZONE, Object.STATION, Object.SKYSCRAPER], snapshot.objects):
+            self.ground.flat[cells] = obj
+        self.air = np.full(self.shape, EMPTY, dtype=np.int32)
+        self.air[self.positions[:, 0], self.positions[:, 1]] = np.arange(self.n_drones)
+        self._count_blocked_cells()
+        self._restore_rngs(snapshot)
+
+    def get_state(self):
+        """
+        The live arrays of the engine: `ground` and `air` grids, drone `positions`, `charge`
+        and `packet` by drone index, all updated in place by the next step
+        """
+        return {
+            'ground': self.ground,
+            'air': self.air,
+            'positions': self.positions,
+            'charge': self.charge,
+            'packet': self.packet,
+        }
+
+    def step(self, actions):
+        info = {}
+        if isinstance(actions, dict):
+            action_array = np.array([actions[index] for index in range(self.n_drones)], dtype=np.int64)
+        else:
+            action_array = np.asarray(actions, dtype=np.int64)
+            actions = dict(enumerate(action_array.tolist()))
+        step_rewards, step_dones = self._step_arrays(action_array)
+
+        step_rewards, step_dones = step_rewards.tolist(), step_dones.tolist()
+        rewards = {index: step_rewards[index] for index in actions.keys()}
+        dones = {index: step_dones[index] for index in actions.keys()}
+        return self.get_state(), rewards, dones, None, info
+
+    def _step_arrays(self, actions):
+        rank = np.empty(self.n_drones, dtype=np.int64)
+        rank[self.order] = np.arange(self.n_drones)
+
+        outcome = resolve_moves(
+            self.ground[None], self.positions[None], self.charge[None], self.packet[None],
+            rank[None], actions[None], self.env_params)
+        crashed = outcome.crashed[0]
+
+        # Move survivors, keeping the iteration order of the dict engine
+        survivors = self.order[~crashed[self.order]]
+        old_cells = self._flat(self.positions)
+        new_cells = self._flat(outcome.positions[0, survivors])
+        newly_occupied = new_cells[self.air.flat[new_cells] == EMPTY]
+        self.air.flat[old_cells] = EMPTY
+        self.positions[survivors] = outcome.positions[0, survivors]
+        self.air.flat[new_cells] = survivors
+        self.n_flying = len(survivors)
+        self.n_ground_objects -= len(outcome.consumed)
+        if self.drone_cells is not None:
+            self.drone_cells.add_many(np.sort(old_cells[self.air.flat[old_cells] == EMPTY]))
+            self.drone_cells.remove_many(np.sort(newly_occupied))
+            self.ground_cells.add_many(np.sort(outcome.consumed))
+
+        # Respawn crashed drones
+        respawned = np.flatnonzero(crashed)
+        respawned = respawned[np.argsort(outcome.respawn_key[0, respawned], kind='stable')]
+        for index in respawned.tolist():
+            y, x = self._find_drone_cell()
+            self.air[y, x] = index
+            self.positions[index] = (y, x)
+            self.n_flying += 1
+        self.order = np.concatenate([survivors, respawned])
+
+        # Respawn used packets and dropzones
+        respawned_cells = []
+        for obj, count in [(Object.PACKET, outcome.nb_packets[0]), (Object.DROPZONE, outcome.nb_dropzones[0])]:
+            for _ in range(count):
+                y, x = self._find_ground_cell()
+                self.ground[y, x] = obj
+                self.n_ground_objects += 1
+                respawned_cells.append(y * self.side_size + x)
+
+        # check if some packets are immediately picked
+        self._pick_packets_after_respawn()
+
+        changed_cells = np.concatenate([
+            old_cells, self._flat(self.positions), outcome.consumed, np.array(respawned_cells, dtype=np.int64)])
+        self.changed_cells = np.stack(np.divmod(changed_cells, self.side_size), axis=-1)
+        self.world_version += 1
+
+        return outcome.rewards[0], crashed
+
+    def _flat(self, positions):
+        return positions[..., 0].astype(np.int64) * self.side_size + positions[..., 1]
+
+    def _find_drone_cell(self):
+        if self.drone_cells is not None:
+            return self.drone_cells.pop()
+        return self._find_respawn_cell(
+            lambda y, x: self.air[y, x] != EMPTY or self.ground[y, x] == Object.SKYSCRAPER,
+            self.n_flying + self.n_skyscrapers)
+
+    def _find_ground_cell(self):
+        if self.ground_cells is not None:
+            return self.ground_cells.pop()
+        return self._find_respawn_cell(lambda y, x: self.ground[y, x] != 0, self.n_ground_objects)
+
+    def _find_respawn_cell(self, is_blocked, n_blocked):
+        # Same draws as DeliveryDrones._find_respawn_position, checked against the grids
+        if n_blocked >= self.side_size ** 2:
+            raise ValueError("No free cell left on the grid")
+        while True:
+            y = random.randint(0, self.side_size - 1)
+            x = random.randint(0, self.side_size - 1)
+            if not is_blocked(y, x):
+                return y, x
+
+    def _pick_packets_after_respawn(self):
+        ys, xs = self.positions[:, 0], self.positions[:, 1]
+        picked = ~self.packet & (self.ground[ys, xs] == Object.PACKET)
+        # we don't give pickup_reward in this case
+        # as the drone didn't do anything to deserve it
+        self.packet[picked] = True
+        self.ground[ys[picked], xs[picked]] = 0
+        self.n_ground_objects -= np.count_nonzero(picked)
+        if self.ground_cells is not None:
+            self.ground_cells.add_many(np.sort(self._flat(self.positions[picked])))
+
+    def _ground_objects(self, obj):
+        return {(y, x): True for y, x in np.argwhere(self.ground == obj).tolist()}
+
+    @property
+    def drones(self):
+        drones = {}
+        for index in self.order.tolist():
+            drone = Drone(index)
+            drone.packet = bool(self.packet[index])
+            drone.charge = int(self.charge[index])
+            drones[tuple(self.positions[index].tolist())] = drone
+        return drones
+
+    @property
+    def packets(self):
+        return self._ground_objects(Object.PACKET)
+
+    @property
+    def dropzones(self):
+        return self._ground_objects(Object.DROPZONE)
+
+    @property
+    def stations(self):
+        return self._ground_objects(Object.STATION)
+
+    @property
+    def skyscrapers(self):
+        return self._ground_objects(Object.SKYSCRAPER)
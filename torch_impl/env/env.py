@@ -1,8 +1,12 @@
 import random
 import gym.spaces as spaces
 import math
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
 from gym import Env
 
+from .free_cells import FreeCellIndex
+
 
 class Drone():
     def __init__(self, index):
@@ -14,6 +18,46 @@ class Drone():
         return f'D{self.index}, packet={self.packet}, charge={self.charge}'
 
 
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+class EnvSnapshot(NamedTuple):
+    """World state captured by DeliveryDrones.snapshot(), its arrays are read-only"""
+    positions: np.ndarray  # (n_drones, 2) by drone index
+    charge: np.ndarray  # (n_drones,)
+    packet: np.ndarray  # (n_drones,)
+    order: np.ndarray  # drone indices in iteration order
+    objects: Tuple[np.ndarray, ...]  # flat cells of packets, dropzones, stations and skyscrapers
+    free_cells: Optional[Tuple]  # (ground_cells, drone_cells) copies when respawn_sampler='index'
+    random_state: tuple
+    np_random_state: dict
+
+
+def sample_layout(rng, side_size, n_drones, counts):
+    """
+    Draws the cells of all objects without replacement in O(objects)
+    counts are the numbers of skyscrapers, packets, dropzones and stations.
+    Returns flat cell ids of drones (by index), packets, dropzones, stations and skyscrapers
+    """
+    n_cells = side_size ** 2
+    if sum(counts) > n_cells:
+        raise ValueError(f"Not enough positions ({n_cells}) to spawn {sum(counts)} objects")
+    if n_drones > n_cells - counts[0]:
+        raise ValueError(f"Not enough positions ({n_cells - counts[0]}) to spawn {n_drones} objects")
+    cells = rng.choice(n_cells, size=sum(counts), replace=False)
+    skyscrapers, packets, dropzones, stations = np.split(cells, np.cumsum(counts)[:-1])
+
+    # Drones can spawn on anything but skyscrapers: draw ranks among the other cells
+    # and shift each rank by the number of skyscrapers before it
+    ranks = rng.choice(n_cells - len(skyscrapers), size=n_drones, replace=False)
+    skyscrapers_sorted = np.sort(skyscrapers)
+    drones = ranks + np.searchsorted(
+        skyscrapers_sorted - np.arange(len(skyscrapers_sorted)), ranks, side='right')
+    return drones, packets, dropzones, stations, skyscrapers
+
+
 class DeliveryDrones(Env):
     """
     LEFT = 0
@@ -38,6 +82,8 @@ class DeliveryDrones(Env):
         'stations_factor': 2,
         'skyscrapers_factor': 3,
         'rgb_render_rescale': 1.0,
+        'respawn_sampler': 'rejection',  # 'index' draws respawn cells from a free-cell index in O(1)
+        'reset_sampler': 'shuffle',  # 'vectorized' draws the layout in O(objects) from the env's np_random
     }
 
     metadata = {
@@ -48,10 +94,23 @@ class DeliveryDrones(Env):
     def drones_list(self):
         return list(self.drones.values())
 
-    def __init__(self, env_params={}):
+    def __new__(cls, env_params={}, engine='dict'):
+        # engine='array' selects the NumPy engine, which keeps the same gym API and rules but
+        # returns its raw arrays as unwrapped observations, see ArrayDeliveryDrones.get_state
+        if cls is DeliveryDrones and engine != 'dict':
+            if engine != 'array':
+                raise ValueError(f"Unknown engine: {engine}")
+            from .array_env import ArrayDeliveryDrones
+            cls = ArrayDeliveryDrones
+        return super().__new__(cls)
+
+    def __init__(self, env_params={}, engine='dict'):
         self.action_space = spaces.Discrete(self.NUM_ACTIONS)
-        self.env_params = self.DEFAULT_CONFIG
+        self.env_params = dict(self.DEFAULT_CONFIG)
         self.env_params.update(env_params)
+        # Incremented by every reset, step and restore: changed_cells only tell
+        # what changed between world_version - 1 and world_version
+        self.world_version = 0
         self.reset()
 
     def spawn_objects(self, available_pos, num_obj):
@@ -64,40 +123,142 @@ class DeliveryDrones(Env):
             positions_dict[position] = True
         return positions_dict, available_pos
 
-    def reset(self, seed=0):
-        self.drones = {}
-        self.stations = {}
-        self.dropzones = {}
-        self.packets = {}
-        self.skyscrapers = {}
+    def reset(self, seed=None):
+        super().reset(seed=seed)  # seeds self.np_random
+        self._configure()
+        self.drones, self.packets, self.dropzones, self.stations, self.skyscrapers = self._spawn_layout()
+        self._build_free_cells()
+
+        # Check if some packets are immediately picked
+        self._pick_packets_after_respawn()
+
+        # Cells whose content changed during the last step, None when everything did
+        self.changed_cells = None
+        self.world_version += 1
+        return self.get_state(), None
+
+    def _configure(self):
         self.n_drones = self.env_params['n_drones']
         self.side_size = int(math.ceil(math.sqrt(self.env_params['n_drones'] / self.env_params['drone_density'])))
         self.shape = (self.side_size, self.side_size)
 
+    def _build_free_cells(self):
+        # Cells where packets/dropzones can respawn (no ground object)
+        # and where drones can respawn (no drone, no skyscraper)
+        sampler = self.env_params['respawn_sampler']
+        if sampler == 'index':
+            ground = [*self.skyscrapers, *self.packets, *self.dropzones, *self.stations]
+            self.ground_cells = FreeCellIndex(self.side_size, np.sort(self._cells(ground)))
+            self.drone_cells = FreeCellIndex(self.side_size, np.sort(self._cells([*self.drones, *self.skyscrapers])))
+        elif sampler == 'rejection':
+            self.ground_cells = self.drone_cells = None
+        else:
+            raise ValueError(f"Unknown respawn sampler: {sampler}")
+
+    def _cells(self, positions):
+        return np.array([y * self.side_size + x for y, x in positions], dtype=np.int64)
+
+    def _object_counts(self):
+        return (
+            self.env_params['skyscrapers_factor'] * self.env_params['n_drones'],
+            self.env_params['packets_factor'] * self.env_params['n_drones'],
+            self.env_params['dropzones_factor'] * self.env_params['n_drones'],
+            self.env_params['stations_factor'] * self.env_params['n_drones'],
+        )
+
+    def _sample_layout(self):
+        return sample_layout(self.np_random, self.side_size, self.n_drones, self._object_counts())
+
+    def _spawn_layout(self):
+        sampler = self.env_params['reset_sampler']
+        if sampler == 'vectorized':
+            cells = self._sample_layout()
+            drones, packets, dropzones, stations, skyscrapers = [
+                [divmod(cell, self.side_size) for cell in objects.tolist()] for objects in cells]
+            return (
+                {position: Drone(i) for i, position in enumerate(drones)},
+                dict.fromkeys(packets, True),
+                dict.fromkeys(dropzones, True),
+                dict.fromkeys(stations, True),
+                dict.fromkeys(skyscrapers, True),
+            )
+        elif sampler != 'shuffle':
+            raise ValueError(f"Unknown reset sampler: {sampler}")
+
+        drones = {}
+
         # Create elements of the grid
-        num_skyscrapers = self.env_params['skyscrapers_factor'] * self.env_params['n_drones']
-        num_packets = self.env_params['packets_factor'] * self.env_params['n_drones']
-        num_dropzone = self.env_params['dropzones_factor'] * self.env_params['n_drones']
-        num_stations = self.env_params['stations_factor'] * self.env_params['n_drones']
+        num_skyscrapers, num_packets, num_dropzone, num_stations = self._object_counts()
         available_positions = [(x, y) for x in range(self.side_size) for y in range(self.side_size)]
-        self.skyscrapers, available_positions = self.spawn_objects(available_positions, num_skyscrapers)
+        skyscrapers, available_positions = self.spawn_objects(available_positions, num_skyscrapers)
 
         # Add the drones, which don't remove their positions from available_positions
         # as they can spawn on packets, dropzones or stations
         for i, p in enumerate(random.sample(available_positions, self.n_drones)):
-            self.drones[p] = Drone(i)
+            drones[p] = Drone(i)
 
-        self.packets, available_positions = self.spawn_objects(
+        packets, available_positions = self.spawn_objects(
             available_positions, num_packets)
-        self.dropzones, available_positions = self.spawn_objects(
+        dropzones, available_positions = self.spawn_objects(
             available_positions, num_dropzone)
-        self.stations, available_positions = self.spawn_objects(
+        stations, available_positions = self.spawn_objects(
             available_positions, num_stations)
+        return drones, packets, dropzones, stations, skyscrapers
+
+    def snapshot(self):
+        """Captures the world and RNG states, see restore()"""
+        drones = list(self.drones.items())
+        order = np.array([drone.index for _, drone in drones], dtype=np.int64)
+        positions = np.zeros((self.n_drones, 2), dtype=np.int32)
+        charge = np.zeros(self.n_drones, dtype=np.int32)
+        packet = np.zeros(self.n_drones, dtype=bool)
+        if drones:
+            positions[order] = [position for position, _ in drones]
+            charge[order] = [drone.charge for _, drone in drones]
+            packet[order] = [drone.packet for _, drone in drones]
+        objects = [self.packets, self.dropzones, self.stations, self.skyscrapers]
+        return EnvSnapshot(
+            positions=_frozen(positions),
+            charge=_frozen(charge),
+            packet=_frozen(packet),
+            order=_frozen(order),
+            objects=tuple(_frozen(self._cells(positions)) for positions in objects),
+            **self._snapshot_rngs(),
+        )
+
+    def _snapshot_rngs(self):
+        free_cells = None
+        if self.ground_cells is not None:
+            free_cells = (self.ground_cells.copy(), self.drone_cells.copy())
+        return {
+            'free_cells': free_cells,
+            'random_state': random.getstate(),
+            'np_random_state': self.np_random.bit_generator.state,
+        }
 
-        # Check if some packets are immediately picked
-        self._pick_packets_after_respawn()
-
-        return self.get_state(), None
+    def restore(self, snapshot):
+        """Puts the world and RNGs back in the state captured by snapshot()"""
+        positions = snapshot.positions.tolist()
+        charge, packet = snapshot.charge.tolist(), snapshot.packet.tolist()
+        self.drones = {}
+        for index in snapshot.order.tolist():
+            drone = Drone(index)
+            drone.charge, drone.packet = charge[index], packet[index]
+            self.drones[tuple(positions[index])] = drone
+        self.packets, self.dropzones, self.stations, self.skyscrapers = [
+            dict.fromkeys([divmod(cell, self.side_size) for cell in cells.tolist()], True)
+            for cells in snapshot.objects]
+        self._restore_rngs(snapshot)
+
+    def _restore_rngs(self, snapshot):
+        if snapshot.free_cells is None:
+            self.ground_cells = self.drone_cells = None
+        else:
+            self.ground_cells, self.drone_cells = [index.copy() for index in snapshot.free_cells]
+        random.setstate(snapshot.random_state)
+        self.np_random.bit_generator.state = snapshot.np_random_state
+        self.changed_cells = None
+        self.world_version += 1
 
     def get_state(self):
         return {
@@ -114,6 +275,8 @@ class DeliveryDrones(Env):
         dones = {index: False for index in actions.keys()}
 
         new_drones = {}
+        old_positions = self.drones.keys()
+        consumed_positions = []
         crashed_drones = []
         crashed_drone_locations = []
         nb_dropzones_to_respawn = 0
@@ -157,11 +320,13 @@ class DeliveryDrones(Env):
                     rewards[drone.index] = self.env_params['pickup_reward']
                     drone.packet = True
                     del self.packets[position]
+                    consumed_positions.append(position)
                 elif position in self.dropzones and drone.packet:
                     #print(f"DELIVERY from drone {drone}!!")
                     rewards[drone.index] = self.env_params['delivery_reward']
                     drone.packet = False
                     del self.dropzones[position]
+                    consumed_positions.append(position)
                     nb_dropzones_to_respawn += 1
                     nb_packets_to_respawn += 1
 
@@ -180,6 +345,10 @@ class DeliveryDrones(Env):
                 del new_drones[crashed_drone_location]
 
         self.drones = new_drones
+        if self.drone_cells is not None:
+            self.drone_cells.add_many(np.sort(self._cells(old_positions - new_drones.keys())))
+            self.drone_cells.remove_many(np.sort(self._cells(new_drones.keys() - old_positions)))
+            self.ground_cells.add_many(np.sort(self._cells(consumed_positions)))
 
         # Respawn crashed drones
         for crashed_drone in crashed_drones:
@@ -189,31 +358,31 @@ class DeliveryDrones(Env):
                 crashed_drone.packet = False
             rewards[crashed_drone.index] = self.env_params['crash_reward']
             dones[crashed_drone.index] = True
-            respawn_position = self._find_respawn_position(self.drones | self.skyscrapers)
+            respawn_position = self._find_drone_position()
             self.drones[respawn_position] = crashed_drone
             #print(f"Respawned crashed drone {crashed_drone} at {respawn_position}")
 
         # Respawn used packets and dropzones
-        ground_mask = {}
-        ground_mask.update(self.skyscrapers)
-        ground_mask.update(self.packets)
-        ground_mask.update(self.dropzones)
-        ground_mask.update(self.stations)
+        respawned_positions = []
         for _ in range(nb_packets_to_respawn):
-            position = self._find_respawn_position(ground_mask)
+            position = self._find_ground_position()
             self.packets[position] = True
-            ground_mask[position] = True
+            respawned_positions.append(position)
         for _ in range(nb_dropzones_to_respawn):
-            position = self._find_respawn_position(ground_mask)
+            position = self._find_ground_position()
             self.dropzones[position] = True
-            ground_mask[position] = True
+            respawned_positions.append(position)
 
         # check if some packets are immediately picked
         self._pick_packets_after_respawn()
 
+        self.changed_cells = [*old_positions, *self.drones.keys(), *consumed_positions, *respawned_positions]
+        self.world_version += 1
+
         return self.get_state(), rewards, dones, None, info
 
     def _pick_packets_after_respawn(self):
+        picked_positions = []
         for drone_pos, drone in self.drones.items():
             if drone.packet is False and drone_pos in self.packets:
                 # we don't give pickup_reward in this case
@@ -221,14 +390,30 @@ class DeliveryDrones(Env):
                 #print(f"SPAWN PICKUP from {drone}!")
                 drone.packet = True
                 del self.packets[drone_pos]
-
-    def _find_respawn_position(self, mask={}):
+                picked_positions.append(drone_pos)
+        if self.ground_cells is not None:
+            self.ground_cells.add_many(np.sort(self._cells(picked_positions)))
+
+    def _find_drone_position(self):
+        if self.drone_cells is not None:
+            return self.drone_cells.pop()
+        return self._find_respawn_position(self.drones, self.skyscrapers)
+
+    def _find_ground_position(self):
+        if self.ground_cells is not None:
+            return self.ground_cells.pop()
+        return self._find_respawn_position(self.skyscrapers, self.packets, self.dropzones, self.stations)
+
+    def _find_respawn_position(self, *masks):
+        # masks are disjoint, so they leave no cell free once they cover the grid
+        if sum(len(mask) for mask in masks) >= self.side_size ** 2:
+            raise ValueError("No free cell left on the grid")
         while True:
             p = (
                 random.randint(0, self.side_size - 1),
                 random.randint(0, self.side_size - 1)
             )
-            if p not in mask:
+            if not any(p in mask for mask in masks):
                 return p
 
     def render(self, mode='ansi'):
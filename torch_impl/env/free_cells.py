@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+
+
+class FreeCellIndex:
+    """
+    Set of free grid cells with O(1) insert, delete and uniform sampling
+
+    Cells are flat ids (y * side_size + x). The free cells are kept in `cells[:size]`
+    and `slots` maps every cell to its position in `cells`, so removing a cell swaps it
+    with the last free one. The batch versions do the same swaps with array operations.
+    """
+
+    def __init__(self, side_size, occupied=()):
+        self.side_size = side_size
+        self.cells = np.arange(side_size ** 2, dtype=np.int64)
+        self.slots = np.arange(side_size ** 2, dtype=np.int64)
+        self.size = side_size ** 2
+        self.remove_many(np.asarray(occupied, dtype=np.int64))
+
+    def copy(self):
+        index = object.__new__(FreeCellIndex)
+        index.side_size, index.size = self.side_size, self.size
+        index.cells, index.slots = self.cells.copy(), self.slots.copy()
+        return index
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, cell):
+        return self.slots[cell] < self.size
+
+    def add(self, cell):
+        slot, last = self.slots[cell], self.size
+        if slot < last:
+            return
+        other = self.cells[last]
+        self.cells[slot], self.cells[last] = other, cell
+        self.slots[other], self.slots[cell] = slot, last
+        self.size += 1
+
+    def remove(self, cell):
+        slot, last = self.slots[cell], self.size - 1
+        if slot > last:
+            return
+        other = self.cells[last]
+        self.cells[slot], self.cells[last] = other, cell
+        self.slots[other], self.slots[cell] = slot, last
+        self.size -= 1
+
+    def add_many(self, cells):
+        """Adds distinct cells that are all currently occupied"""
+        k, start = len(cells), self.size
+        slots = self.slots[cells]
+        in_place = slots < start + k
+        # Free cells must end up in [start, start + k): occupied cells sitting there move out
+        stays = np.zeros(k, dtype=bool)
+        stays[slots[in_place] - start] = True
+        movers = self.cells[start:start + k][~stays]
+        self.cells[slots[~in_place]] = movers
+        self.slots[movers] = slots[~in_place]
+        self.cells[start:start + k] = cells
+        self.slots[cells] = np.arange(start, start + k)
+        self.size += k
+
+    def remove_many(self, cells):
+        """Removes distinct cells that are all currently free"""
+        k, end = len(cells), self.size
+        slots = self.slots[cells]
+        in_place = slots >= end - k
+        # Removed cells must end up in [end - k, end): free cells sitting there move out
+        stays = np.zeros(k, dtype=bool)
+        stays[slots[in_place] - (end - k)] = True
+        movers = self.cells[end - k:end][~stays]
+        self.cells[slots[~in_place]] = movers
+        self.slots[movers] = slots[~in_place]
+        self.cells[end - k:end] = cells
+        self.slots[cells] = np.arange(end - k, end)
+        self.size -= k
+
+    def sample(self):
+        if self.size == 0:
+            raise ValueError("No free cell left on the grid")
+        return int(self.cells[random.randrange(self.size)])
+
+    def pop(self):
+        cell = self.sample()
+        self.remove(cell)
+        return divmod(cell, self.side_size)
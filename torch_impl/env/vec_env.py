@@ -0,0 +1,399 @@
+import math
+import multiprocessing as mp
+import os
+import random
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+import gym.spaces as spaces
+from numpy.lib.stride_tricks import sliding_window_view
+
+from common.constants import Object
+from .env import DeliveryDrones, sample_layout
+from .array_env import EMPTY, resolve_moves
+from .wrappers import WindowedGridView
+
+
+class VecDeliveryDrones:
+    """
+    N independent DeliveryDrones worlds stepped together
+
+    The worlds are stacked along a leading axis (ground/air grids, drone positions, charge
+    and packets) and every step resolves all of them with the array engine rules. Actions,
+    observations, rewards and dones are arrays of shape (num_envs, n_drones, ...), the
+    observations being the windows of WindowedGridView.
+
+    Each world draws its layouts from its own Generator, so `seeds` fix every world
+    independently of num_envs; respawns are drawn for all worlds at once from `np_random`.
+    Worlds reset themselves after `max_episode_steps` steps.
+    """
+
+    def __init__(self, num_envs, env_params={}, radius=3, max_episode_steps=None, seeds=None):
+        assert radius > 0, "Radius should be strictly positive"
+        self.num_envs = num_envs
+        self.radius = radius
+        self.max_episode_steps = max_episode_steps
+        self.env_params = dict(DeliveryDrones.DEFAULT_CONFIG)
+        self.env_params.update(env_params)
+        self.n_drones = self.env_params['n_drones']
+        self.side_size = int(math.ceil(math.sqrt(self.env_params['n_drones'] / self.env_params['drone_density'])))
+        self.counts = tuple(
+            self.env_params[f'{name}_factor'] * self.n_drones
+            for name in ['skyscrapers', 'packets', 'dropzones', 'stations'])
+
+        self.action_space = spaces.Discrete(DeliveryDrones.NUM_ACTIONS)
+        self.observation_space = spaces.Box(
+            low=0, high=1, shape=(self.radius * 2 + 1, self.radius * 2 + 1, 6), dtype=float
+        )
+
+        shape = (num_envs, self.side_size, self.side_size)
+        self.ground = np.zeros(shape, dtype=np.int8)
+        self.air = np.full(shape, EMPTY, dtype=np.int32)
+        self.positions = np.zeros((num_envs, self.n_drones, 2), dtype=np.int32)
+        self.charge = np.full((num_envs, self.n_drones), 100, dtype=np.int32)
+        self.packet = np.zeros((num_envs, self.n_drones), dtype=bool)
+        # Position of each drone in the iteration order of the dict engine
+        self.rank = np.zeros((num_envs, self.n_drones), dtype=np.int64)
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+        self.reset(seeds)
+
+    def reset(self, seeds=None):
+        """seeds is None, an int or one int per world"""
+        if seeds is None or np.isscalar(seeds):
+            sequences = np.random.SeedSequence(seeds).spawn(self.num_envs + 1)
+        else:
+            if len(seeds) != self.num_envs:
+                raise ValueError(f"Expected {self.num_envs} seeds, got {len(seeds)}")
+            sequences = [np.random.SeedSequence(seed) for seed in seeds]
+            sequences.append(np.random.SeedSequence(list(seeds)))
+        self.world_rngs = [np.random.default_rng(sequence) for sequence in sequences[:-1]]
+        self.np_random = np.random.default_rng(sequences[-1])
+        self._reset_worlds(np.arange(self.num_envs))
+        return self.observation(), None
+
+    def _reset_worlds(self, worlds):
+        for world in worlds.tolist():
+            drones, packets, dropzones, stations, skyscrapers = sample_layout(
+                self.world_rngs[world], self.side_size, self.n_drones, self.counts)
+            ground = self.ground[world].reshape(-1)
+            ground[:] = 0
+            for obj, cells in [
+                    (Object.SKYSCRAPER, skyscrapers), (Object.PACKET, packets),
+                    (Object.DROPZONE, dropzones), (Object.STATION, stations)]:
+                ground[cells] = obj
+            air = self.air[world].reshape(-1)
+            air[:] = EMPTY
+            air[drones] = np.arange(self.n_drones)
+            self.positions[world] = np.stack(np.divmod(drones, self.side_size), axis=-1)
+        self.charge[worlds] = 100
+        self.packet[worlds] = False
+        self.rank[worlds] = np.arange(self.n_drones)
+        self.steps[worlds] = 0
+
+        # Check if some packets are immediately picked
+        self._pick_packets_after_respawn()
+
+    def step(self, actions):
+        """
+        actions: (num_envs, n_drones) array of actions
+        Returns observations, rewards and dones of shape (num_envs, n_drones, ...), a (num_envs,)
+        truncation mask for the worlds that were reset and an info dict
+        holding their last observations under 'final_observation'
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        outcome = resolve_moves(
+            self.ground, self.positions, self.charge, self.packet, self.rank, actions, self.env_params)
+        crashed = outcome.crashed
+
+        # Move survivors
+        worlds = np.broadcast_to(np.arange(self.num_envs)[:, None], crashed.shape)
+        drones = np.broadcast_to(np.arange(self.n_drones), crashed.shape)
+        self.air[worlds, self.positions[..., 0], self.positions[..., 1]] = EMPTY
+        survivors = ~crashed
+        self.positions[survivors] = outcome.positions[survivors]
+        self.air[worlds[survivors], self.positions[survivors][:, 0], self.positions[survivors][:, 1]] = \
+            drones[survivors]
+
+        # Respawn crashed drones, which then come last in iteration order
+        respawned_worlds, respawned = np.nonzero(crashed)
+        cells = self._sample_free_cells(
+            (self.air != EMPTY) | (self.ground == Object.SKYSCRAPER), respawned_worlds)
+        self.air.reshape(-1)[cells] = respawned
+        cells %= self.side_size ** 2
+        self.positions[respawned_worlds, respawned, 0] = cells // self.side_size
+        self.positions[respawned_worlds, respawned, 1] = cells % self.side_size
+        order_key = np.where(crashed, self.n_drones + outcome.respawn_key, self.rank)
+        self.rank = np.argsort(np.argsort(order_key, axis=1, kind='stable'), axis=1)
+
+        # Respawn used packets and dropzones
+        packet_worlds = np.repeat(np.arange(self.num_envs), outcome.nb_packets)
+        dropzone_worlds = np.repeat(np.arange(self.num_envs), outcome.nb_dropzones)
+        cells = self._sample_free_cells(self.ground != 0, np.concatenate([packet_worlds, dropzone_worlds]))
+        ground = self.ground.reshape(-1)
+        ground[cells[:len(packet_worlds)]] = Object.PACKET
+        ground[cells[len(packet_worlds):]] = Object.DROPZONE
+
+        # check if some packets are immediately picked
+        self._pick_packets_after_respawn()
+
+        states = self.observation()
+        info = {}
+        self.steps += 1
+        truncated = np.zeros(self.num_envs, dtype=bool)
+        if self.max_episode_steps is not None:
+            truncated = self.steps >= self.max_episode_steps
+        if truncated.any():
+            info['final_observation'] = states[truncated]
+            reset_worlds = np.flatnonzero(truncated)
+            self._reset_worlds(reset_worlds)
+            states[truncated] = self.observation(reset_worlds)
+        return states, outcome.rewards, crashed, truncated, info
+
+    def _sample_free_cells(self, blocked, worlds):
+        """
+        Draws one distinct non-blocked cell per entry of worlds, for all worlds at once
+        Returns flat cell ids over the stacked grids
+        """
+        n_cells = self.side_size ** 2
+        requested = np.bincount(worlds, minlength=self.num_envs)
+        if (requested > n_cells - blocked.reshape(self.num_envs, -1).sum(axis=1)).any():
+            raise ValueError("No free cell left on the grid")
+
+        blocked = blocked.reshape(-1)
+        cells = np.empty(len(worlds), dtype=np.int64)
+        pending = np.arange(len(worlds))
+        while len(pending) > 0:
+            candidates = worlds[pending] * n_cells + self.np_random.integers(n_cells, size=len(pending))
+            # A cell drawn several times goes to its first request, the others draw again
+            accepted = np.zeros(len(pending), dtype=bool)
+            accepted[np.unique(candidates, return_index=True)[1]] = True
+            accepted &= ~blocked[candidates]
+            cells[pending[accepted]] = candidates[accepted]
+            blocked[candidates[accepted]] = True
+            pending = pending[~accepted]
+        return cells
+
+    def _pick_packets_after_respawn(self):
+        worlds = np.arange(self.num_envs)[:, None]
+        ys, xs = self.positions[..., 0], self.positions[..., 1]
+        picked = ~self.packet & (self.ground[worlds, ys, xs] == Object.PACKET)
+        # we don't give pickup_reward in this case
+        # as the drone didn't do anything to deserve it
+        self.packet[picked] = True
+        self.ground[np.nonzero(picked)[0], ys[picked], xs[picked]] = 0
+
+    def observation(self, worlds=None):
+        """WindowedGridView windows of every drone: (len(worlds), n_drones, 2r+1, 2r+1, 6)"""
+        if worlds is None:
+            worlds = np.arange(self.num_envs)
+        ground, air, positions = self.ground[worlds], self.air[worlds], self.positions[worlds]
+
+        # Full padded grids with walls as obstacles: like WindowedGridView, channel 5
+        # is set on the whole grid and not only on skyscrapers
+        padded_grid = np.zeros(
+            (len(worlds), self.side_size + 2 * self.radius, self.side_size + 2 * self.radius, 6),
+            dtype=np.float32)
+        padded_grid[..., 5] = 1
+        grid = padded_grid[:, self.radius:-self.radius, self.radius:-self.radius]
+
+        drone = air != EMPTY
+        grid[..., 0] = drone
+        grid[..., 1] = drone | (ground == Object.PACKET)
+        grid[..., 2] = ground == Object.DROPZONE
+        grid[..., 3] = ground == Object.STATION
+        drone_worlds, ys, xs = np.nonzero(drone)
+        grid[drone_worlds, ys, xs, 4] = self.charge[worlds][drone_worlds, air[drone_worlds, ys, xs]] / 100
+
+        # Window of padded_grid starting at (y, x) is centered on grid cell (y, x)
+        size = self.radius * 2 + 1
+        windows = sliding_window_view(padded_grid, (size, size), axis=(1, 2))
+        states = windows[np.arange(len(worlds))[:, None], positions[..., 0], positions[..., 1]]
+        return np.ascontiguousarray(states.transpose(0, 1, 3, 4, 2))
+
+
+def _shared_arrays(buffer, specs):
+    """NumPy views over buffer, one per (name, shape, dtype) of specs, laid out back to back"""
+    arrays, offset = {}, 0
+    for name, shape, dtype in specs:
+        dtype = np.dtype(dtype)
+        offset += -offset % dtype.alignment
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += arrays[name].nbytes
+    return arrays
+
+
+def _shared_size(specs):
+    return sum(np.prod(shape, dtype=np.int64) * np.dtype(dtype).itemsize + 8 for _, shape, dtype in specs)
+
+
+def _worker(remote, parent_remote, shm_name, specs, worlds, env_params, engine, radius, max_episode_steps):
+    parent_remote.close()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = _shared_arrays(shm.buf, specs)
+    envs = [WindowedGridView(DeliveryDrones(env_params, engine=engine), radius=radius) for _ in worlds]
+    steps = np.zeros(len(worlds), dtype=np.int64)
+
+    def write_states(world, states, out):
+        for index, state in states.items():
+            out[world, index] = state
+
+    try:
+        while True:
+            command, data = remote.recv()
+            try:
+                if command == 'step':
+                    for i, (env, world) in enumerate(zip(envs, worlds)):
+                        actions = dict(enumerate(buffers['actions'][world].tolist()))
+                        states, rewards, dones, _, _ = env.step(actions)
+                        write_states(world, states, buffers['states'])
+                        for index in rewards.keys():
+                            buffers['rewards'][world, index] = rewards[index]
+                            buffers['dones'][world, index] = dones[index]
+                        steps[i] += 1
+                        truncated = max_episode_steps is not None and steps[i] >= max_episode_steps
+                        buffers['truncated'][world] = truncated
+                        if truncated:
+                            buffers['final_states'][world] = buffers['states'][world]
+                            write_states(world, env.reset(), buffers['states'])
+                            steps[i] = 0
+                elif command == 'reset':
+                    # Both engines draw respawns from the process-wide random module
+                    random.seed(data[0])
+                    for i, (env, world, seed) in enumerate(zip(envs, worlds, data)):
+                        write_states(world, env.reset(seed=seed), buffers['states'])
+                        steps[i] = 0
+                elif command == 'close':
+                    remote.send(None)
+                    break
+                else:
+                    raise ValueError(f"Unknown command: {command}")
+                remote.send(None)
+            except Exception:
+                remote.send(traceback.format_exc())
+    finally:
+        for env in envs:
+            env.close()
+        del buffers
+        shm.close()
+
+
+class SubprocVecDeliveryDrones:
+    """
+    WindowedGridView(DeliveryDrones) worlds spread over worker processes
+
+    Workers write observations, rewards and dones straight into one shared memory block and
+    only exchange small command messages with the parent, so no array is pickled per step.
+    The arrays returned by reset/step are zero-copy views over that block: they are
+    overwritten by the next step, copy them to keep them around.
+
+    Each worker seeds the random module with the seed of its first world, so episodes are
+    reproducible for a fixed num_workers. Worlds reset themselves after `max_episode_steps`
+    steps, like VecDeliveryDrones.
+    """
+
+    def __init__(self, num_envs, env_params={}, radius=3, engine='array', num_workers=None,
+                 max_episode_steps=None, seeds=None, start_method='spawn'):
+        self.num_envs = num_envs
+        self.radius = radius
+        self.env_params = dict(DeliveryDrones.DEFAULT_CONFIG)
+        self.env_params.update(env_params)
+        self.n_drones = self.env_params['n_drones']
+        self.action_space = spaces.Discrete(DeliveryDrones.NUM_ACTIONS)
+        self.observation_space = spaces.Box(
+            low=0, high=1, shape=(self.radius * 2 + 1, self.radius * 2 + 1, 6), dtype=float
+        )
+
+        states_shape = (num_envs, self.n_drones, *self.observation_space.shape)
+        specs = [
+            ('actions', (num_envs, self.n_drones), np.int64),
+            ('states', states_shape, np.float32),
+            ('final_states', states_shape, np.float32),
+            ('rewards', (num_envs, self.n_drones), np.float64),
+            ('dones', (num_envs, self.n_drones), bool),
+            ('truncated', (num_envs,), bool),
+        ]
+        self._shm = shared_memory.SharedMemory(create=True, size=int(_shared_size(specs)))
+        self._buffers = _shared_arrays(self._shm.buf, specs)
+
+        num_workers = min(num_envs, num_workers or os.cpu_count())
+        context = mp.get_context(start_method)
+        self.remotes, self.processes = [], []
+        for worlds in np.array_split(np.arange(num_envs), num_workers):
+            remote, work_remote = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(work_remote, remote, self._shm.name, specs, worlds.tolist(),
+                      self.env_params, engine, radius, max_episode_steps),
+                daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append((remote, worlds))
+            self.processes.append(process)
+        self.waiting = False
+        self.closed = False
+        self.reset(seeds)
+
+    def reset(self, seeds=None):
+        """seeds is None, an int or one int per world"""
+        if seeds is None or np.isscalar(seeds):
+            seeds = np.random.SeedSequence(seeds).generate_state(self.num_envs).tolist()
+        elif len(seeds) != self.num_envs:
+            raise ValueError(f"Expected {self.num_envs} seeds, got {len(seeds)}")
+        for remote, worlds in self.remotes:
+            remote.send(('reset', [seeds[world] for world in worlds]))
+        self._wait()
+        return self._buffers['states'], None
+
+    def step_async(self, actions):
+        """Starts stepping all worlds with actions of shape (num_envs, n_drones)"""
+        self._buffers['actions'][:] = actions
+        for remote, _ in self.remotes:
+            remote.send(('step', None))
+        self.waiting = True
+
+    def step_wait(self):
+        """Waits for the step started by step_async, returns the same values as VecDeliveryDrones.step"""
+        self._wait()
+        self.waiting = False
+        info = {}
+        truncated = self._buffers['truncated']
+        if truncated.any():
+            info['final_observation'] = self._buffers['final_states'][truncated]
+        return self._buffers['states'], self._buffers['rewards'], self._buffers['dones'], truncated, info
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def _wait(self):
+        errors = [error for error in (remote.recv() for remote, _ in self.remotes) if error is not None]
+        if errors:
+            raise RuntimeError(f"Worker failed:\n{errors[0]}")
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            self._wait()
+        for remote, _ in self.remotes:
+            remote.send(('close', None))
+        for (remote, _), process in zip(self.remotes, self.processes):
+            remote.recv()
+            process.join()
+            remote.close()
+        # Views handed out by step may outlive the env: unlink first so the block
+        # is freed once they are gone, and only close our mapping if nothing uses it
+        self._buffers = None
+        self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,18 +1,91 @@
+from collections.abc import Mapping
+
 import numpy as np
 import gym.spaces as spaces
 import gym
 
+from common.constants import Object
+from .array_env import ArrayDeliveryDrones, EMPTY
+
+
+def encode_compact(grid):
+    """
+    Compact form of (..., 6) float observations: (..., 2) uint8 with bit c of channel 0 set
+    when binary channel c is, and the charge channel scaled to 0-100 in channel 1
+    """
+    compact = np.zeros((*grid.shape[:-1], 2), dtype=np.uint8)
+    for channel in [0, 1, 2, 3, 5]:
+        compact[..., 0] |= (grid[..., channel] > 0).astype(np.uint8) << channel
+    compact[..., 1] = np.rint(grid[..., 4] * 100)
+    return compact
+
+
+def compact_space(shape):
+    return spaces.Box(low=0, high=255, shape=(*shape[:-1], 2), dtype=np.uint8)
+
+
+def drone_positions(env):
+    """(n_drones, 2) positions indexed by drone index"""
+    env = env.unwrapped
+    if isinstance(env, ArrayDeliveryDrones):
+        return env.positions.copy()  # The env updates its array in place
+    positions = np.zeros((env.n_drones, 2), dtype=np.int64)
+    for position, drone in env.drones.items():
+        positions[drone.index] = position
+    return positions
+
+
+def drone_charges(env):
+    """(n_drones,) charges indexed by drone index"""
+    env = env.unwrapped
+    if isinstance(env, ArrayDeliveryDrones):
+        return env.charge.copy()
+    charges = np.zeros(env.n_drones, dtype=np.int64)
+    for drone in env.drones.values():
+        charges[drone.index] = drone.charge
+    return charges
+
+
+class SharedGridStates(Mapping):
+    """
+    States of GridView(shared=True): every drone maps to the same read-only global grid
+    positions and charge hold the (n_drones, 2) positions and (n_drones,) charges / 100 by drone index
+    """
+
+    def __init__(self, grid, positions, charge):
+        self.grid, self.positions, self.charge = grid, positions, charge
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.positions):
+            raise KeyError(index)
+        return self.grid
+
+    def __iter__(self):
+        return iter(range(len(self.positions)))
+
+    def __len__(self):
+        return len(self.positions)
+
 
 class GridView(gym.ObservationWrapper):
-    def __init__(self, env):
+    """
+    shared: return a SharedGridStates holding one read-only grid for all drones instead of
+    a copy of the grid per drone, so memory and time no longer grow with n_drones * side ** 2
+    compact: return uint8 observations in the format of encode_compact
+    """
+
+    def __init__(self, env, shared=False, compact=False):
         super().__init__(env, new_step_api=True)
+        self.shared = shared
+        self.compact = compact
         self.observation_space = spaces.Box(
             low=0, high=1, shape=(self.side_size, self.side_size, 6), dtype=float
         )
+        if compact:
+            self.observation_space = compact_space(self.observation_space.shape)
 
     def observation(self, _):
         grid = np.zeros((self.env.side_size, self.env.side_size, 6), dtype=np.float32)
-        print(grid.shape)
 
         for (y, x), drone in self.env.drones.items():
             grid[y, x, 0] = 1
@@ -32,6 +105,12 @@ class GridView(gym.ObservationWrapper):
         for (y, x) in self.env.skyscrapers.keys():
             grid[y, x, 5] = 1
 
+        if self.compact:
+            grid = encode_compact(grid)
+        if self.shared:
+            grid.flags.writeable = False
+            return SharedGridStates(grid, drone_positions(self.env), drone_charges(self.env) / 100)
+
         states = {}
         for (y, x), drone in self.env.drones.items():
             states[drone.index] = grid.copy()
@@ -39,15 +118,114 @@ class GridView(gym.ObservationWrapper):
 
 
 class WindowedGridView(gym.ObservationWrapper):
-    def __init__(self, env, radius):
+    """
+    as_array: return all windows as one (n_drones, 2r+1, 2r+1, 6) array indexed by drone index
+    copy: with as_array, False returns a read-only array that is overwritten at every step
+    compact: return uint8 observations in the format of encode_compact
+    """
+
+    def __init__(self, env, radius, as_array=False, copy=True, compact=False):
         super().__init__(env, new_step_api=True)
         self.radius = radius
+        self.as_array = as_array
+        self.copy = copy
+        self.compact = compact
         assert radius > 0, "Radius should be strictly positive"
         self.observation_space = spaces.Box(
             low=0, high=1, shape=(self.radius * 2 + 1, self.radius * 2 + 1, 6), dtype=float
         )
+        if compact:
+            self.observation_space = compact_space(self.observation_space.shape)
+        # Padded grid kept across steps and updated with the cells the env reports as changed
+        self.padded_grid = None
+        self.grid_version = None
+        self.compact_grid = None
+        self.windows = None
 
     def observation(self, _):
+        changed_cells = self.env.changed_cells
+        up_to_date = self.grid_version is not None and self.env.world_version == self.grid_version + 1
+        self.grid_version = self.env.world_version
+        if not up_to_date or changed_cells is None:
+            self.padded_grid = self._build_grid()
+            if self.compact:
+                self.compact_grid = encode_compact(self.padded_grid)
+        else:
+            self._update_grid(changed_cells)
+            if self.compact:
+                ys, xs = (np.asarray(changed_cells, dtype=np.int64).reshape(-1, 2) + self.radius).T
+                self.compact_grid[ys, xs] = encode_compact(self.padded_grid[ys, xs])
+        padded_grid = self.compact_grid if self.compact else self.padded_grid
+        if self.as_array:
+            return self._gather_windows(padded_grid)
+
+        states = {}
+        # Extract windowed views for each drone
+        for (y, x), drone in self.env.drones.items():
+            # Calculate absolute positions with padding offset
+            top_left_y = y + self.radius
+            top_left_x = x + self.radius
+            states[drone.index] = padded_grid[
+                top_left_y - self.radius: top_left_y + self.radius + 1,
+                top_left_x - self.radius: top_left_x + self.radius + 1,
+                :
+            ].copy()
+
+        return states
+
+    def _gather_windows(self, padded_grid):
+        # Flat index of every window element in the padded grid: the window of
+        # grid cell (y, x) starts at padded cell (y, x)
+        size = self.radius * 2 + 1
+        full_size, _, channels = padded_grid.shape
+        offsets = ((np.arange(size)[:, None] * full_size + np.arange(size))[:, :, None] * channels
+                   + np.arange(channels)).ravel()
+        positions = drone_positions(self.env)
+        corners = (positions[:, 0].astype(np.int64) * full_size + positions[:, 1]) * channels
+        index = corners[:, None] + offsets
+        shape = (len(positions), size, size, channels)
+
+        if self.copy:
+            return padded_grid.reshape(-1)[index].reshape(shape)
+        if self.windows is None or self.windows.shape != shape or self.windows.dtype != padded_grid.dtype:
+            self.windows = np.empty(shape, dtype=padded_grid.dtype)
+        self.windows.flags.writeable = True
+        np.take(padded_grid.reshape(-1), index, out=self.windows.reshape(len(positions), -1))
+        self.windows.flags.writeable = False
+        return self.windows
+
+    def _update_grid(self, changed_cells):
+        # Channel 5 never changes: it is set on the whole grid, see _build_grid
+        grid = self.padded_grid[self.radius:-self.radius, self.radius:-self.radius]
+        env = self.env.unwrapped
+        if isinstance(env, ArrayDeliveryDrones):
+            ys, xs = changed_cells[:, 0], changed_cells[:, 1]
+            air, ground = env.air[ys, xs], env.ground[ys, xs]
+            drone = air != EMPTY
+            grid[ys, xs, 0] = drone
+            grid[ys, xs, 1] = drone | (ground == Object.PACKET)
+            grid[ys, xs, 2] = ground == Object.DROPZONE
+            grid[ys, xs, 3] = ground == Object.STATION
+            grid[ys, xs, 4] = np.where(drone, env.charge[air] / 100, 0)
+            return
+
+        for position in changed_cells:
+            y, x = position
+            cell = grid[y, x]
+            cell[:5] = 0
+            drone = env.drones.get(position)
+            if drone is not None:
+                cell[0] = 1
+                cell[1] = 1
+                cell[4] = drone.charge / 100
+            if position in env.packets:
+                cell[1] = 1
+            if position in env.dropzones:
+                cell[2] = 1
+            if position in env.stations:
+                cell[3] = 1
+
+    def _build_grid(self):
         # Compute full padded grid size
         full_size = self.env.side_size + 2 * self.radius
         padded_grid = np.zeros((full_size, full_size, 6), dtype=np.float32)
@@ -77,16 +255,4 @@ class WindowedGridView(gym.ObservationWrapper):
         for (y, x) in self.env.skyscrapers.keys():
             grid[y, x, 5] = 1
 
-        states = {}
-        # Extract windowed views for each drone
-        for (y, x), drone in self.env.drones.items():
-            # Calculate absolute positions with padding offset
-            top_left_y = y + self.radius
-            top_left_x = x + self.radius
-            states[drone.index] = padded_grid[
-                top_left_y - self.radius: top_left_y + self.radius + 1,
-                top_left_x - self.radius: top_left_x + self.radius + 1,
-                :
-            ].copy()
-
-        return states
+        return padded_grid
@@ -1,12 +1,11 @@
-from typing import Tuple, Optional
-import shutil
+from typing import Tuple
 import torch
 import logging
 from tqdm import trange
 import os
-import tempfile
 import numpy as np
 from common.render import Renderer
+from common.video import VideoEncoder
 from env.env import DeliveryDrones
 from env.wrappers import WindowedGridView
 from agents.random import RandomAgent
@@ -40,7 +39,6 @@ def render_video(
         n_drones: int = 3,
         num_steps: int = 300,
         output_path: str = './out.mp4',
-        temp_dir: Optional[str] = None,
         drone_density: float = 0.03,
         fps: int = 2,
         ):
@@ -83,9 +81,7 @@ def render_video(
 
     # starting frame
     # img = renderer.render_frame(*convert_python_state(0, env))
-    if temp_dir is None:
-        temp_dir = tempfile.mkdtemp()
-    os.makedirs(temp_dir, exist_ok=True)
+    video = VideoEncoder([(output_path, None)], fps=fps)
 
     for key, agent in agents.items():
         agent.is_greedy = True
@@ -99,9 +95,8 @@ def render_video(
         states, rewards, dones, _, _ = env.step(actions)
 
         img = renderer.render_frame(*convert_python_state(env, rewards, actions))
-        renderer.save_frame(img, temp_dir)
-    renderer.generate_video(temp_dir, output_path, output_resolution=img.size, fps=fps)
-    shutil.rmtree(temp_dir)
+        video.write(img)
+    video.close()
     logger.info(f'Generated video {os.path.abspath(output_path)}')
 
 
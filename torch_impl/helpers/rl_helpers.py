@@ -8,6 +8,8 @@ import torch
 from tqdm import tqdm
 from base64 import b64encode
 
+from common.video import VideoEncoder
+
 
 def set_seed(env, seed):
     """Helper function to set the seeds when needed"""
@@ -18,6 +20,40 @@ def set_seed(env, seed):
     random.seed(seed)  # seed for Python random library
 
 
+def act_all(agents, states):
+    """Actions of all agents, drones sharing an agent with act_batch are batched in one call"""
+    groups = defaultdict(list)
+    for key, agent in agents.items():
+        groups[id(agent)].append(key)
+
+    actions = {}
+    for keys in groups.values():
+        agent = agents[keys[0]]
+        if len(keys) > 1 and hasattr(agent, 'act_batch'):
+            actions.update(agent.act_batch([states[key] for key in keys], keys))
+        else:
+            for key in keys:
+                actions[key] = agent.act(states[key])
+    return {key: actions[key] for key in agents.keys()}
+
+
+def learn_all(agents, states, actions, rewards, next_states, dones):
+    """Lets all agents learn from a step, drones sharing an agent with learn_batch are pooled in one call"""
+    groups = defaultdict(list)
+    for key, agent in agents.items():
+        groups[id(agent)].append(key)
+
+    for keys in groups.values():
+        agent = agents[keys[0]]
+        if len(keys) > 1 and hasattr(agent, 'learn_batch'):
+            agent.learn_batch(
+                [states[key] for key in keys], [actions[key] for key in keys], [rewards[key] for key in keys],
+                [next_states[key] for key in keys], [dones[key] for key in keys], keys)
+        else:
+            for key in keys:
+                agent.learn(states[key], actions[key], rewards[key], next_states[key], dones[key])
+
+
 class MultiAgentTrainer:
     """A class to train agents in a multi-agent environment"""
 
@@ -51,7 +87,7 @@ class MultiAgentTrainer:
 
         for i in tqdm(range(n_steps), 'Training agents'):
             # Select actions based on current states
-            actions = {key: agent.act(states[key]) for key, agent in self.agents.items()}
+            actions = act_all(self.agents, states)
 
             # Perform the selected action
             self.step = self.env.step(actions)
@@ -59,11 +95,16 @@ class MultiAgentTrainer:
             # print(self.env.render())
 
             # Learn from experience
-            for key, agent in self.agents.items():
-                agent.learn(states[key], actions[key], rewards[key], next_states[key], dones[key])
+            learn_all(self.agents, states, actions, rewards, next_states, dones)
+            for key in self.agents.keys():
                 self.rewards_log[key].append(rewards[key])
             states = next_states
 
+        # Stop background work of the agents, e.g. batch prefetching
+        for agent in set(self.agents.values()):
+            if hasattr(agent, 'close'):
+                agent.close()
+
 
 def test_agents(env, agents, n_steps, seed=None):
     """Function to test agents"""
@@ -81,7 +122,7 @@ def test_agents(env, agents, n_steps, seed=None):
     for _ in tqdm(range(n_steps), 'Testing agents'):
         # Select actions based on current states
         with torch.no_grad():
-            actions = {key: agent.act(states[key]) for key, agent in agents.items()}
+            actions = act_all(agents, states)
 
         # Perform the selected action
         next_states, rewards, dones, _, _ = env.step(actions)
@@ -173,8 +214,6 @@ def plot_rolling_rewards(rewards_log, window=None, hline=None, events={'delivery
 
 
 def render_video(env, agents, video_path, n_steps=60, fps=1, seed=None):
-    from moviepy.editor import ImageClip, concatenate_videoclips
-
     # Initialization
     if seed is not None:
         set_seed(env, seed=seed)
@@ -184,23 +223,19 @@ def render_video(env, agents, video_path, n_steps=60, fps=1, seed=None):
     for key, agent in agents.items():
         agent.is_greedy = True
 
-    # Run agents
-    frames = []
+    # Run agents, frames are encoded while the agents run
+    video = VideoEncoder([(video_path, None)], fps=fps)
     for _ in tqdm(range(n_steps), 'Running agents', unit='frame'):
         # Select actions based on current states
-        actions = {key: agent.act(states[key]) for key, agent in agents.items()}
+        actions = act_all(agents, states)
 
         # Perform the selected action
         next_states, rewards, dones, _, _ = env.step(actions)
         states = next_states
 
         # Save frame
-        frames.append(env.render(mode='rgb_array'))
-
-    # Create video
-    clips = [ImageClip(frame).set_duration(fps) for frame in frames]
-    concat_clip = concatenate_videoclips(clips, method="compose")
-    concat_clip.write_videofile(video_path, fps=24)
+        video.write(env.render(mode='rgb_array'))
+    video.close()
 
 
 class ColabVideo():